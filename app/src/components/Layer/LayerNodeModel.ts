@@ -8,7 +8,9 @@ export class LayerNodeModel extends BaseNodeModel {
 		super('layer', block.id);
 
 		this.color = '#70C1B3';
-		this.addPort(new BasePortModel(true, 'input'));
+		block.inputs.forEach((input) => {
+			this.addPort(new BasePortModel(true, input));
+		});
 		block.outputs.forEach((output) => {
 			this.addPort(new BasePortModel(false, output));
 		});
@@ -1,16 +1,166 @@
-export function readMatrixFromBuffer(data: ArrayBuffer) {
+// Marks the second version of the binary matrix format.
+// The first version started with the amount of dims, which is never negative.
+const MATRIX_V2 = -2;
+
+// Encodings of the values in a serialized matrix, these are flags
+// that can be combined
+const ENCODING_RAW = 0;
+// Values xor'ed with the values of an earlier matrix, grouped by byte
+// (all first bytes, then all second bytes, ...) and zlib compressed
+const ENCODING_XOR_ZLIB = 1;
+// uint8 values, that are mapped to [min, max] of the matrix (or of
+// each channel = last dim). The header holds the mins and step sizes
+const ENCODING_QUANTIZED = 2;
+
+function hasEncoding(encoding: number, flag: number) {
+	return Math.floor(encoding / flag) % 2 === 1;
+}
+
+// Data types of the values, by their code in the header
+const DTYPE_FLOAT32 = 0;
+const DTYPE_FLOAT16 = 1;
+const DTYPE_UINT8 = 2;
+const DTYPE_INT8 = 3;
+const DTYPE_UINT16 = 4;
+const DTYPE_INT16 = 5;
+const DTYPE_UINT32 = 6;
+const DTYPE_INT32 = 7;
+const DTYPE_FLOAT64 = 8;
+
+// Size of a value in bytes, by data type
+const DTYPE_SIZES = [4, 2, 1, 1, 2, 2, 4, 4, 8];
+
+// Decode IEEE 754 half precision floats
+function readHalfFloats(halfs: Uint16Array) {
+	const vals = new Float32Array(halfs.length);
+	for (let i = 0; i < halfs.length; i++) {
+		const h = halfs[i];
+		const sign = h >= 0x8000 ? -1 : 1;
+		const exp = Math.floor(h / 0x400) % 0x20;
+		const frac = h % 0x400;
+		if (exp === 0) {
+			vals[i] = sign * Math.pow(2, -14) * (frac / 1024);
+		} else if (exp === 0x1f) {
+			vals[i] = frac ? NaN : sign * Infinity;
+		} else {
+			vals[i] = sign * Math.pow(2, exp - 15) * (1 + frac / 1024);
+		}
+	}
+	return vals;
+}
+
+export interface MatrixHeader {
+	dtype: number;
+	encoding: number;
+	dims: Int32Array;
+	// Params of quantized matrices
+	mins?: Float32Array;
+	steps?: Float32Array;
+	offset: number;
+}
+
+// Read the header of a serialized matrix (both format versions)
+export function readMatrixHeader(data: ArrayBuffer): MatrixHeader {
 	let off = 0;
-	const numDims = new Int32Array(data, off, 1)[0];
+	const first = new Int32Array(data, off, 1)[0];
 	off += 4;
 
-	if (numDims === 0) {
-		return [];
+	// Version 1: [nDims] [dim1, dim2, ...] [float32 values]
+	if (first !== MATRIX_V2) {
+		const dims = new Int32Array(data, off, first);
+		off += first * 4;
+		return {
+			dtype: DTYPE_FLOAT32,
+			encoding: ENCODING_RAW,
+			dims,
+			offset: off
+		};
 	}
 
+	// Version 2: [-2] [dtype: u8] [encoding: u8] [reserved: u16] [nDims]
+	// [dim1, dim2, ...] [params of the encoding] [padding to 8 bytes] [values]
+	const view = new DataView(data);
+	const dtype = view.getUint8(off);
+	const encoding = view.getUint8(off + 1);
+	off += 4;
+	const numDims = view.getInt32(off, true);
+	off += 4;
 	const dims = new Int32Array(data, off, numDims);
 	off += numDims * 4;
 
-	let vals: any = new Float32Array(data, off);
+	// Quantized: [n] [mins: float32 * n] [steps: float32 * n]
+	let mins: Float32Array | undefined;
+	let steps: Float32Array | undefined;
+	if (hasEncoding(encoding, ENCODING_QUANTIZED)) {
+		const n = view.getInt32(off, true);
+		off += 4;
+		mins = new Float32Array(data.slice(off, off + n * 4));
+		off += n * 4;
+		steps = new Float32Array(data.slice(off, off + n * 4));
+		off += n * 4;
+	}
+
+	off += (8 - (off % 8)) % 8;
+	return { dtype, encoding, dims, mins, steps, offset: off };
+}
+
+// Map quantized values back to their range
+function readQuantized(
+	vals: Uint8Array,
+	mins: Float32Array,
+	steps: Float32Array
+) {
+	const n = mins.length;
+	const out = new Float32Array(vals.length);
+	for (let i = 0; i < vals.length; i++) {
+		const c = i % n;
+		out[i] = mins[c] + vals[i] * steps[c];
+	}
+	return out;
+}
+
+// Get the flat values of a serialized matrix
+export function readMatrixValues(data: ArrayBuffer, header: MatrixHeader) {
+	const off = header.offset;
+	if (header.mins && header.steps) {
+		return readQuantized(
+			new Uint8Array(data, off),
+			header.mins,
+			header.steps
+		);
+	}
+	switch (header.dtype) {
+		case DTYPE_FLOAT16:
+			return readHalfFloats(new Uint16Array(data, off));
+		case DTYPE_UINT8:
+			return new Uint8Array(data, off);
+		case DTYPE_INT8:
+			return new Int8Array(data, off);
+		case DTYPE_UINT16:
+			return new Uint16Array(data, off);
+		case DTYPE_INT16:
+			return new Int16Array(data, off);
+		case DTYPE_UINT32:
+			return new Uint32Array(data, off);
+		case DTYPE_INT32:
+			return new Int32Array(data, off);
+		case DTYPE_FLOAT64:
+			return new Float64Array(data, off);
+		case DTYPE_FLOAT32:
+		default:
+			return new Float32Array(data, off);
+	}
+}
+
+export function readMatrixFromBuffer(data: ArrayBuffer) {
+	const header = readMatrixHeader(data);
+	const dims = header.dims;
+
+	if (dims.length === 0) {
+		return [];
+	}
+
+	let vals: any = readMatrixValues(data, header);
 
 	// Construct the matrix from inner-most dimension outwards
 	for (let i = dims.length - 1; i > 0; i--) {
@@ -24,3 +174,50 @@ export function readMatrixFromBuffer(data: ArrayBuffer) {
 
 	return vals;
 }
+
+// Whether this browser can decompress matrix deltas
+export function canReadMatrixDeltas() {
+	return typeof (window as any).DecompressionStream !== 'undefined';
+}
+
+// Decompress zlib compressed data
+function inflate(data: ArrayBuffer): Promise<ArrayBuffer> {
+	const stream = (new Blob([data]) as any)
+		.stream()
+		.pipeThrough(new (window as any).DecompressionStream('deflate'));
+	return new Response(stream).arrayBuffer();
+}
+
+// Apply a delta to the (raw) matrix it was computed from.
+// Returns the raw matrix, or the data itself if it isn't a delta.
+export function applyMatrixDelta(
+	data: ArrayBuffer,
+	base: ArrayBuffer
+): Promise<ArrayBuffer> {
+	const header = readMatrixHeader(data);
+	if (!hasEncoding(header.encoding, ENCODING_XOR_ZLIB)) {
+		return Promise.resolve(data);
+	}
+
+	return inflate(data.slice(header.offset)).then(delta => {
+		const bytes = new Uint8Array(delta);
+		const size = DTYPE_SIZES[header.dtype];
+		const n = bytes.length / size;
+		const baseBytes = new Uint8Array(base, readMatrixHeader(base).offset);
+
+		// Copy the header, but mark the values as no longer being a delta
+		const out = new ArrayBuffer(header.offset + bytes.length);
+		new Uint8Array(out).set(new Uint8Array(data, 0, header.offset));
+		new DataView(out).setUint8(5, header.encoding - ENCODING_XOR_ZLIB);
+
+		// Put the bytes of each value back together and undo the xor
+		const vals = new Uint8Array(out, header.offset);
+		for (let i = 0; i < n; i++) {
+			for (let j = 0; j < size; j++) {
+				// tslint:disable-next-line:no-bitwise
+				vals[i * size + j] = bytes[j * n + i] ^ baseBytes[i * size + j];
+			}
+		}
+		return out;
+	});
+}
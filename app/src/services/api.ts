@@ -1,6 +1,10 @@
 import * as io from 'socket.io-client';
 
-import { readMatrixFromBuffer } from '../components/Util';
+import {
+	applyMatrixDelta,
+	canReadMatrixDeltas,
+	readMatrixFromBuffer
+} from '../components/Util';
 import { Block, Link, Variable } from '../types';
 
 const socket = io('http://localhost:8080');
@@ -11,6 +15,12 @@ export type BatchBeginListener = (batch: number, batches: number) => void;
 
 export type BlockListener = (blocks: Block) => void;
 export type BlocksListener = (blocks: Block[]) => void;
+export interface BlockPosition {
+	id: string;
+	x: number;
+	y: number;
+}
+export type BlockMoveListener = (block: BlockPosition) => void;
 
 export type PortListener = (id: string, port: string) => void;
 export type PortRenameListener = (
@@ -21,11 +31,69 @@ export type PortRenameListener = (
 
 export type LinkListener = (link: Link) => void;
 
+// Statistics about the output of a visual block
+export interface ResultSummary {
+	size: number;
+	nan: number;
+	inf: number;
+	min: number | null;
+	max: number | null;
+	mean: number | null;
+	std: number | null;
+	histogram: { counts: number[]; edges: number[] } | null;
+}
+
 export type ResultListener = (
 	id: string,
-	blocks: { [x: string]: boolean }
+	blocks: { [x: string]: boolean },
+	summaries: { [x: string]: ResultSummary | null }
+) => void;
+
+export type ReduceMode = 'stride' | 'mean' | 'max' | 'min' | 'minmax';
+export type QuantizeMode = 'float16' | 'uint8' | 'uint8-channel';
+
+// Options for retrieving only part of a result
+export interface ResultOptions {
+	// [start, stop] per dim, null to keep the whole dim
+	roi?: Array<[number, number] | null>;
+	// Maximum size of the result, for all dims or per dim
+	shape?: number | Array<number | null>;
+	reduce?: ReduceMode;
+	// Lossy encoding, overrides the setting of the visual block
+	quantize?: QuantizeMode | null;
+}
+
+// Describes how a result was cut and reduced on the server
+export interface ResultMeta {
+	shape: number[];
+	roi: Array<[number, number]>;
+	factors: number[];
+	mode: ReduceMode;
+	// Fingerprint of the encoding, to request deltas against this result
+	encoding: string;
+	// The execution this result is a delta to, if any
+	base?: string;
+}
+
+export type PushListener = (
+	id: string,
+	results: { [x: string]: [string | null, any, ResultMeta | undefined] }
 ) => void;
 
+// Metrics of the latest batches, rows are [step, metric1, metric2, ...]
+export type MetricsListener = (names: string[], rows: number[][]) => void;
+
+// Decimated history of the training metrics
+export interface MetricsHistory {
+	names: string[];
+	// Amount of batches per bucket
+	bucket: number;
+	// First step of each bucket
+	steps: number[];
+	// Min, max and mean of each bucket as [3, buckets, metrics]
+	values: number[][][];
+}
+
 export type DataCallback = (
 	blocks: Block[],
 	links: Link[],
@@ -41,10 +109,11 @@ class API {
 	trainEnd: Listener[] = [];
 	epochBegin: EpochBeginListener[] = [];
 	batchBegin: BatchBeginListener[] = [];
+	metrics: MetricsListener[] = [];
 
 	blockCreate: BlockListener[] = [];
 	blockChange: BlockListener[] = [];
-	blockMove: BlockListener[] = [];
+	blockMove: BlockMoveListener[] = [];
 	blockDelete: BlockListener[] = [];
 
 	portCreate: PortListener[] = [];
@@ -55,6 +124,22 @@ class API {
 	linkDelete: LinkListener[] = [];
 
 	newResult: ResultListener[] = [];
+	pushResult: PushListener[] = [];
+
+	// Our result subscription, we renew it when reconnecting
+	subscription: { blocks: string[] } & ResultOptions | null = null;
+
+	// The last matrix we got for each block, the server
+	// can send new results as differences to these
+	rawResults: {
+		[blockId: string]: {
+			id: string;
+			options: string;
+			// How the server encoded the matrix (see ResultMeta)
+			encoding: string;
+			data: ArrayBuffer;
+		};
+	} = {};
 
 	connected = false;
 
@@ -62,6 +147,9 @@ class API {
 		// Subscribe to events
 		socket.on('connect', () => {
 			this.connected = true;
+			if (this.subscription) {
+				socket.emit('result_subscribe', this.subscription);
+			}
 			this.connect.forEach(l => l());
 		});
 		socket.on('disconnect', () => {
@@ -81,6 +169,10 @@ class API {
 			({ batch, batches }: { batch: number; batches: number }) =>
 				this.batchBegin.forEach(l => l(batch, batches))
 		);
+		socket.on('metrics', (data: any) => {
+			const rows = readMatrixFromBuffer(data.data);
+			this.metrics.forEach(l => l(data.names, rows));
+		});
 
 		socket.on('block_create', (block: Block) =>
 			this.blockCreate.forEach(l => l(block))
@@ -88,14 +180,16 @@ class API {
 		socket.on('block_change', (block: Block) =>
 			this.blockChange.forEach(l => l(block))
 		);
-		socket.on('block_move', (block: Block) =>
-			this.blockMove.forEach(l => l(block))
+		// Moves are batched by the server, with the latest position of each block
+		socket.on('block_moves', (moves: BlockPosition[]) =>
+			moves.forEach(m => this.blockMove.forEach(l => l(m)))
 		);
 		socket.on('block_delete', (block: Block) =>
 			this.blockDelete.forEach(l => l(block))
 		);
+		socket.on('result_push', (data: any) => this.handlePush(data));
 		socket.on('result_new', (data: any) =>
-			this.newResult.forEach(l => l(data.id, data.blocks))
+			this.newResult.forEach(l => l(data.id, data.blocks, data.summaries || {}))
 		);
 
 		socket.on('port_create', ({ id, port }: { id: string; port: string }) =>
@@ -139,6 +233,9 @@ class API {
 	onBatchBegin(listener: BatchBeginListener) {
 		this.batchBegin.push(listener);
 	}
+	onMetrics(listener: MetricsListener) {
+		this.metrics.push(listener);
+	}
 
 	// Block events
 	onBlockCreate(listener: BlockListener) {
@@ -147,7 +244,7 @@ class API {
 	onBlockChange(listener: BlockListener) {
 		this.blockChange.push(listener);
 	}
-	onBlockMove(listener: BlockListener) {
+	onBlockMove(listener: BlockMoveListener) {
 		this.blockMove.push(listener);
 	}
 	onBlockDelete(listener: BlockListener) {
@@ -169,6 +266,22 @@ class API {
 	onNewResult(listener: ResultListener) {
 		this.newResult.push(listener);
 	}
+	onPushResult(listener: PushListener) {
+		this.pushResult.push(listener);
+	}
+
+	// Unpack a batch of pushed results
+	handlePush(data: any) {
+		const res = {};
+		Object.keys(data.errors).forEach(blockId => {
+			res[blockId] = [data.errors[blockId], null, undefined];
+		});
+		data.blocks.forEach((b: any) => {
+			const buffer = data.data.slice(b.offset, b.offset + b.length);
+			res[b.id] = [null, readMatrixFromBuffer(buffer), b.meta];
+		});
+		this.pushResult.forEach(l => l(data.id, res));
+	}
 
 	getData(callback: DataCallback) {
 		socket.emit('data', (data: any) => {
@@ -186,14 +299,21 @@ class API {
 	changeBlock(id: string, code: string) {
 		socket.emit('block_change', { id, code });
 	}
+	changeCaching(id: string, cache: boolean) {
+		socket.emit('block_change', { id, cache });
+	}
+	changeQuantize(id: string, quantize: QuantizeMode | null) {
+		socket.emit('block_change', { id, quantize });
+	}
 	moveBlock(id: string, x: number, y: number) {
 		socket.emit('block_move', { id, x, y });
 	}
 	deleteBlock(id: string) {
 		socket.emit('block_delete', { id });
 	}
-	evalBlock(id: string) {
-		socket.emit('block_eval', { id });
+	// With force, the blocks it depends on are evaluated again as well
+	evalBlock(id: string, force: boolean = false) {
+		socket.emit('block_eval', { id, force });
 	}
 
 	evalAllBlocks() {
@@ -220,21 +340,61 @@ class API {
 	getResult(
 		id: string,
 		blockId: string,
-		callback: (err: string | null, out: any) => void
+		callback: (err: string | null, out: any, meta?: ResultMeta) => void,
+		options: ResultOptions = {}
 	) {
-		socket.emit('result_get', { id, blockId }, (data: any) => {
+		const key = JSON.stringify(options);
+		const raw = this.rawResults[blockId];
+		const useBase =
+			raw && raw.options === key && raw.encoding && canReadMatrixDeltas();
+		const base = useBase ? raw.id : null;
+		const baseEncoding = useBase ? raw.encoding : null;
+
+		const args = { id, blockId, base, baseEncoding, ...options };
+		socket.emit('result_get', args, (data: any) => {
 			if (data[0]) {
 				console.error(data[0]);
 				return callback(data[0], null);
 			}
 			if (data[1] instanceof ArrayBuffer) {
-				callback(null, readMatrixFromBuffer(data[1]));
+				const meta = data[2];
+				const baseData = meta && meta.base ? raw.data : data[1];
+				applyMatrixDelta(data[1], baseData).then(buffer => {
+					this.rawResults[blockId] = {
+						id,
+						options: key,
+						encoding: meta ? meta.encoding : '',
+						data: buffer
+					};
+					callback(null, readMatrixFromBuffer(buffer), meta);
+				});
 			} else {
 				callback(data[0], data[1]);
 			}
 		});
 	}
 
+	// Have the results of these visual blocks pushed after every execution
+	subscribeResults(blockIds: string[], options: ResultOptions = {}) {
+		this.subscription = { blocks: blockIds, ...options };
+		socket.emit('result_subscribe', this.subscription);
+	}
+	unsubscribeResults() {
+		this.subscription = null;
+		socket.emit('result_unsubscribe');
+	}
+
+	getMetrics(callback: (history: MetricsHistory) => void) {
+		socket.emit('metrics_get', (data: any) =>
+			callback({
+				names: data.names,
+				bucket: data.bucket,
+				steps: Array.from(readMatrixFromBuffer(data.steps)),
+				values: readMatrixFromBuffer(data.values)
+			})
+		);
+	}
+
 	startTraining() {
 		socket.emit('train_start');
 	}
@@ -34,6 +34,8 @@ export function isVar(block: Block): block is VariableBlock {
 
 export interface CodeBlock extends Block {
 	code: string;
+	// Whether the server may reuse the output while code and inputs are the same
+	cache: boolean;
 }
 export function isCode(block: Block): block is CodeBlock {
 	return block.class === 'CodeBlock';
@@ -1,24 +1,33 @@
 import eventlet
 import json
+import os
 import sys
 import io
 import uuid
 import math
 import contextlib
+import weakref
+import atexit
 import socketio
 import pickle
+import struct
+import zlib
 import numpy as np
 import traceback as tb
 
 from abc import ABCMeta, abstractmethod
 from collections import OrderedDict, deque
-from eventlet.green import threading, Queue, time
-from flask import Flask, send_from_directory
+from collections.abc import Sequence
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from itertools import count
+from eventlet.green import time
+from eventlet.hubs import trampoline
+from flask import Flask, send_from_directory, request
 from flask_socketio import SocketIO
-from threading import Thread
+from threading import Thread, Lock, RLock, Condition, local, get_ident
 from types import ModuleType
 from keras import Model, backend as K
-from keras.layers import Input, InputLayer
+from keras.layers import Input, InputLayer, Layer
 from keras.optimizers import RMSprop
 from keras.callbacks import Callback
 
@@ -50,46 +59,109 @@ class MyJSONWrapper(object):
         return json.loads(*args, **kwargs)
 
 
-e = threading.Event()
-queue = Queue.Queue()
+class MessageBridge(object):
+    """ Passes messages from any thread to the eventlet web server thread.
+    We need this because sending messages from a normal python thread ->
+    eventlet doesn't work, and we can't run model training on the eventlet
+    (web server) thread because that would block the whole eventlet thread.
+
+    Publishers append to a queue and write a byte to a pipe. The web server
+    thread waits for the pipe to become readable, so the hub wakes up as
+    soon as there is a message, and then delivers the queued messages in
+    batches. If max_size is set and the queue is full, publishing threads
+    either 'block' until there is room again (at most timeout seconds) or
+    'drop' the oldest message. The web server thread itself never blocks """
+
+    def __init__(self, max_size=0, overflow='block', timeout=10,
+                 batch_size=100):
+        self.max_size = max_size
+        self.overflow = overflow
+        self.timeout = timeout
+        self.batch_size = batch_size
+        self.messages = deque()
+        self.dropped = 0
+        self.cond = Condition()
+        # Whether we already wrote a byte to the pipe that wasn't read yet
+        self.signaled = False
+        self.readFd, self.writeFd = os.pipe()
+        os.set_blocking(self.readFd, False)
+        os.set_blocking(self.writeFd, False)
+        # Thread the messages are delivered on
+        self.listener = None
+
+    def put(self, message):
+        with self.cond:
+            if self.max_size > 0 and len(self.messages) >= self.max_size:
+                if self.overflow == 'block' and get_ident() != self.listener:
+                    self.cond.wait_for(
+                        lambda: len(self.messages) < self.max_size,
+                        timeout=self.timeout)
+                if len(self.messages) >= self.max_size:
+                    self.messages.popleft()
+                    self.dropped += 1
+            self.messages.append(message)
+            wake = not self.signaled
+            self.signaled = True
+
+        if wake:
+            try:
+                os.write(self.writeFd, b'x')
+            except BlockingIOError:
+                # The pipe is full, so the listener is already awake
+                pass
 
+    def listen(self):
+        """ Generator of the published messages, runs on the eventlet hub """
 
-class LocalManager(socketio.PubSubManager):
-    name = 'local'
+        self.listener = get_ident()
+        while True:
+            trampoline(self.readFd, read=True)
+            try:
+                os.read(self.readFd, 4096)
+            except BlockingIOError:
+                pass
 
-    def initialize(self):
-        super(LocalManager, self).initialize()
+            # Clear the flag before draining, so a message published while
+            # we drain writes to the pipe again and we don't miss it
+            with self.cond:
+                self.signaled = False
 
-        # This background process is used to inform our web server thread
-        # of new messages arriving in the handler. We need this because
-        # sending messages from a normal python thread -> eventlet doesn't work.
-        # And we can't run model training on the eventlet (web server) thread
-        # because that would block the whole eventlet thread
-        def signal():
             while True:
-                if queue.qsize() > 0:
-                    e.set()
-                time.sleep(0.1)
-        self.server.start_background_task(target=signal)
+                with self.cond:
+                    n = min(len(self.messages), self.batch_size)
+                    batch = [self.messages.popleft() for _ in range(n)]
+                    self.cond.notify_all()
+                if len(batch) == 0:
+                    break
+                for message in batch:
+                    yield message
+                # Let the other green threads run between batches
+                eventlet.sleep(0)
 
-    def _publish(self, data):
-        queue.put(data)
+    def stats(self):
+        return {
+            'queued': len(self.messages),
+            'dropped': self.dropped,
+            'max_size': self.max_size
+        }
 
-    def _do_listen(self):
-        while True:
-            e.wait()
-            for _ in range(queue.qsize()):
-                msg = queue.get_nowait()
-                queue.task_done()
-                yield msg
-            e.clear()
+
+# Messages from all threads to the web server thread, set 'max_size' and
+# 'overflow' to limit how many messages may pile up
+bridge = MessageBridge()
+
+
+class LocalManager(socketio.PubSubManager):
+    name = 'local'
+
+    def _publish(self, data):
+        bridge.put(data)
 
     def _listen(self):
-        for message in self._do_listen():
+        for message in bridge.listen():
             yield message
 
 
-
 # Setup Flask web server & socketio
 mgr = LocalManager()
 app = Flask(__name__, static_url_path='', static_folder='./app/build/')
@@ -109,39 +181,1101 @@ def send_html(path):
     return send_from_directory('./app/build/', path)
 
 
+class ThreadStdout(object):
+    """ Stdout replacement that writes to a per-thread stream if one is set,
+    so blocks running on different threads can capture their own output """
+
+    def __init__(self, default):
+        self.default = default
+        self.local = local()
+
+    def stream(self):
+        return getattr(self.local, 'stdout', None) or self.default
+
+    def write(self, text):
+        return self.stream().write(text)
+
+    def flush(self):
+        return self.stream().flush()
+
+    def __getattr__(self, name):
+        # Anything else (encoding, isatty, fileno, ...) is up to the stream
+        return getattr(self.stream(), name)
+
+
 # Context manager allows us to capture 'print' statements and other output
 # while running exec
 @contextlib.contextmanager
 def stdoutIO(stdout=None):
-    old = sys.stdout
     if stdout is None:
         stdout = io.StringIO()
-    sys.stdout = stdout
-    yield stdout
-    sys.stdout = old
+    if not isinstance(sys.stdout, ThreadStdout):
+        sys.stdout = ThreadStdout(sys.stdout)
+    old = getattr(sys.stdout.local, 'stdout', None)
+    sys.stdout.local.stdout = stdout
+    try:
+        yield stdout
+    finally:
+        sys.stdout.local.stdout = old
+
+
+# Marks the second version of our binary matrix format. The first version
+# started with the amount of dims, so it can never be negative
+MATRIX_V2 = -2
+
+# Data types we can send in binary form, by their code in the header
+MATRIX_DTYPES = [
+    np.dtype('<f4'),
+    np.dtype('<f2'),
+    np.dtype('u1'),
+    np.dtype('i1'),
+    np.dtype('<u2'),
+    np.dtype('<i2'),
+    np.dtype('<u4'),
+    np.dtype('<i4'),
+    np.dtype('<f8'),
+]
+
+# Encodings of the values in a serialized matrix, these are flags
+# that can be combined
+ENCODING_RAW = 0
+# Values xor'ed with the values of an earlier matrix, grouped by byte
+# (all first bytes, then all second bytes, ...) and zlib compressed
+ENCODING_XOR_ZLIB = 1
+# uint8 values, that are mapped to [min, max] of the matrix (or of
+# each channel = last dim). The header holds the mins and step sizes
+ENCODING_QUANTIZED = 2
+
+# Lossy ways to send matrices with less bytes
+QUANTIZE_MODES = ['float16', 'uint8', 'uint8-channel']
+
+
+def matrix_dtype(mat):
+    """ Get the data type we send a matrix as """
+
+    if mat.dtype == np.bool_:
+        return np.dtype('u1')
+    if mat.dtype.kind in 'iu' and mat.dtype.itemsize > 4:
+        # We can't read 64 bit integers in the browser
+        if mat.size == 0 or (mat.min() >= -2**31 and mat.max() < 2**31):
+            return np.dtype('<i4')
+        return np.dtype('<f8')
+    if mat.dtype.kind == 'f' and mat.dtype.itemsize > 4:
+        # Doubles are just not worth the bandwidth for visualizations
+        return np.dtype('<f4')
+
+    dtype = mat.dtype.newbyteorder('<')
+    if dtype in MATRIX_DTYPES:
+        return dtype
+    return np.dtype('<f4')
+
+
+def matrix_header(dtype, encoding, dims, params=b''):
+    """ Pack the header of a serialized matrix:
+    [-2] [dtype: u8] [encoding: u8] [reserved: u16] [nDims] [dim1, dim2, ...]
+    [params of the encoding]
+    Padded to 8 bytes, so the values can be viewed as typed arrays """
+
+    header = struct.pack('<iBBHi' + 'i' * len(dims), MATRIX_V2,
+                         MATRIX_DTYPES.index(dtype), encoding, 0, len(dims),
+                         *dims) + params
+    return header + bytes(-len(header) % 8)
+
+
+def quantize_matrix(mat, perChannel=False):
+    """ Map the values of a matrix to uint8. Returns the values and the
+    params to restore them: [n] [mins: float32 * n] [steps: float32 * n] """
+
+    mat = np.asarray(mat, dtype=np.float32)
+    axis = tuple(range(mat.ndim - 1)) if perChannel and mat.ndim > 1 else None
+
+    # The range only covers the finite values, so a few infinite values
+    # don't ruin it. Without any finite values we use [0, 0]
+    finite = np.isfinite(mat)
+    lo = np.atleast_1d(
+        np.min(np.where(finite, mat, np.inf), axis=axis, initial=np.inf))
+    hi = np.atleast_1d(
+        np.max(np.where(finite, mat, -np.inf), axis=axis, initial=-np.inf))
+    lo[~np.isfinite(lo)] = 0
+    hi[~np.isfinite(hi)] = 0
+    step = (hi - lo) / 255
+    step[step == 0] = 1
+
+    with np.errstate(invalid='ignore'):
+        vals = np.rint((mat - lo) / step)
+    np.clip(vals, 0, 255, out=vals)
+    # Infinite values end up at the ends of the range, NaNs at the start
+    vals[mat == np.inf] = 255
+    vals[mat == -np.inf] = 0
+    vals[np.isnan(vals)] = 0
+
+    params = struct.pack('<i', len(lo)) + lo.astype('<f4').tobytes() + \
+        step.astype('<f4').tobytes()
+    return vals.astype(np.uint8), params
+
+
+def encode_matrix(mat, quantize=None):
+    """ Convert a matrix to what we send: The contiguous array of values,
+    the encoding and its params. Returns None if the matrix is empty.
+    This doesn't copy if the matrix is already in the right format """
+
+    if np.isscalar(mat):
+        mat = np.array([mat])
+
+    if mat is None:
+        return None
+
+    mat = np.asarray(mat)
+    if mat.size == 0:
+        return None
+
+    if quantize is not None and quantize not in QUANTIZE_MODES:
+        raise ValueError('Invalid quantize mode ' + str(quantize))
+
+    # Integers are usually labels or images, those we leave alone
+    if mat.dtype.kind == 'f':
+        if quantize == 'float16':
+            return np.ascontiguousarray(mat, dtype='<f2'), ENCODING_RAW, b''
+        if quantize is not None:
+            vals, params = quantize_matrix(
+                mat, perChannel=quantize == 'uint8-channel')
+            return vals, ENCODING_QUANTIZED, params
+
+    mat = np.ascontiguousarray(mat, dtype=matrix_dtype(mat))
+    return mat, ENCODING_RAW, b''
+
+
+def serialize_matrix(mat, quantize=None):
+    """ Serialize a matrix to an array of bytes: [header] [values]
+    (see matrix_header). Values are sent with their own data type where
+    possible, and without copying them if they're already contiguous.
+    Float matrices can be quantized to one of the QUANTIZE_MODES """
 
+    enc = encode_matrix(mat, quantize)
+    if enc is None:
+        return matrix_header(MATRIX_DTYPES[0], ENCODING_RAW, ())
 
-def serialize_matrix(mat):
-    """ Serialize a matrix to an array of bytes: [nDims] [dim1, dim2, ...] [values]"""
+    mat, encoding, params = enc
+    return b''.join((matrix_header(mat.dtype, encoding, mat.shape, params),
+                     memoryview(mat.reshape(-1).view(np.uint8))))
+
+
+def serialize_matrix_delta(mat, base, quantize=None):
+    """ Serialize a matrix as the difference to a base matrix the client
+    already has: The bits of the values are xor'ed with those of the base,
+    which makes the sign, exponent and high bits mostly zeros for similar
+    values. Grouping the bytes by their position keeps those zeros together
+    for the compression. Returns None if the matrices don't have the same
+    type and shape """
+
+    enc = encode_matrix(mat, quantize)
+    baseEnc = encode_matrix(base, quantize)
+    if enc is None or baseEnc is None:
+        return None
+
+    mat, encoding, params = enc
+    base = baseEnc[0]
+    if mat.dtype != base.dtype or mat.shape != base.shape \
+            or encoding != baseEnc[1]:
+        return None
+
+    delta = np.bitwise_xor(
+        mat.reshape(-1).view(np.uint8), base.reshape(-1).view(np.uint8))
+    delta = np.ascontiguousarray(delta.reshape(-1, mat.itemsize).T)
+    return matrix_header(mat.dtype, encoding | ENCODING_XOR_ZLIB, mat.shape,
+                         params) + zlib.compress(memoryview(delta), 1)
+
+
+# Ways of reducing a matrix to a smaller resolution
+REDUCE_MODES = ['stride', 'mean', 'max', 'min', 'minmax']
+
+
+def reduce_matrix(mat, roi=None, shape=None, mode='stride'):
+    """ Cut a region out of a matrix and reduce it to (at most) the given
+    shape. roi is a list of [start, stop] per dim, shape either one size
+    for all dims or a list of sizes (None keeps a dim as is). Mode 'minmax'
+    adds a leading dim holding both the min and the max of each bin.
+    Returns the reduced matrix and metadata about what was done """
+
+    if np.isscalar(mat):
+        mat = np.array([mat])
+    mat = np.asanyarray(mat)
+
+    if mode not in REDUCE_MODES:
+        raise ValueError('Invalid reduce mode ' + str(mode))
+
+    # Resolve the region of interest
+    roi = roi if roi is not None else []
+    slices = tuple(
+        slice(*roi[i]) if i < len(roi) and roi[i] is not None else slice(None)
+        for i in range(mat.ndim))
+    region = [list(sl.indices(n)[:2]) for sl, n in zip(slices, mat.shape)]
+    full = list(mat.shape)
+    mat = mat[slices]
+
+    # Size of the bins we reduce each dim with
+    if shape is None or np.isscalar(shape):
+        shape = [shape] * mat.ndim
+    factors = [
+        1 if i >= len(shape) or shape[i] is None or shape[i] <= 0
+        or n <= shape[i] else int(math.ceil(n / shape[i]))
+        for i, n in enumerate(mat.shape)
+    ]
+
+    meta = {
+        'shape': full,
+        'roi': region,
+        'factors': factors,
+        'mode': mode
+    }
+
+    if all(f == 1 for f in factors):
+        if mode == 'minmax':
+            mat = np.stack((mat, mat))
+        return mat, meta
+
+    if mode == 'stride':
+        return mat[tuple(slice(None, None, f) for f in factors)], meta
+
+    # The other modes are separable, so we reduce one dim after the other
+    def reduce(ufunc, m):
+        for axis, f in enumerate(factors):
+            if f > 1:
+                m = ufunc.reduceat(m, np.arange(0, m.shape[axis], f), axis)
+        return m
+
+    if mode == 'max':
+        return reduce(np.maximum, mat), meta
+    if mode == 'min':
+        return reduce(np.minimum, mat), meta
+    if mode == 'minmax':
+        return np.stack((reduce(np.minimum, mat), reduce(np.maximum, mat))), meta
+
+    # Mean: Sum up each bin, then divide by the bin sizes
+    sums = reduce(np.add, mat.astype(np.float64, copy=False))
+    for axis, f in enumerate(factors):
+        if f > 1:
+            n = mat.shape[axis]
+            sizes = np.diff(np.append(np.arange(0, n, f), n))
+            sums /= sizes.reshape([-1] + [1] * (mat.ndim - axis - 1))
+    return sums.astype(np.float32), meta
+
+
+# Amount of bins of the histograms we send along with new results
+HISTOGRAM_BINS = 32
+
+
+def summarize_matrix(mat, bins=HISTOGRAM_BINS):
+    """ Summary statistics and a histogram of the values of a matrix,
+    so clients can pick a scale before fetching the whole matrix.
+    Returns None for anything that isn't numeric """
 
     if np.isscalar(mat):
         mat = np.array([mat])
+    if not isinstance(mat, np.ndarray) or mat.dtype.kind not in 'biuf':
+        return None
+
+    vals = mat.reshape(-1)
+    if vals.dtype.kind == 'b':
+        vals = vals.view(np.uint8)
+
+    # NaN and Inf would break every other statistic, so leave them out
+    nans = 0
+    infs = 0
+    if vals.dtype.kind == 'f':
+        finite = np.isfinite(vals)
+        if not finite.all():
+            nans = int(np.isnan(vals).sum())
+            infs = int(vals.size - finite.sum()) - nans
+            vals = vals[finite]
+
+    summary = {
+        'size': int(mat.size),
+        'nan': nans,
+        'inf': infs,
+        'min': None,
+        'max': None,
+        'mean': None,
+        'std': None,
+        'histogram': None
+    }
+    if vals.size == 0:
+        return summary
+
+    lo = vals.min()
+    hi = vals.max()
+    counts, edges = np.histogram(vals, bins=bins, range=(lo, hi))
+    summary.update({
+        'min': float(lo),
+        'max': float(hi),
+        'mean': float(vals.mean(dtype=np.float64)),
+        'std': float(vals.std(dtype=np.float64)),
+        'histogram': {
+            'counts': counts.tolist(),
+            'edges': edges.tolist()
+        }
+    })
+    return summary
+
+
+class FunctionCache(object):
+    """ Cache of compiled backend functions, keyed by layer and by the
+    signature of the input/output tensors. Building a K.function adds new
+    ops to the graph, so we only want to do this once per signature """
+
+    def __init__(self):
+        self.funcs = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, layer, inputs, outputs):
+        """ Get a compiled function mapping inputs -> outputs for a layer """
+
+        key = (layer.name, tuple(t.name for t in inputs),
+               tuple(t.name for t in outputs))
+        entry = self.funcs.get(key)
+
+        # The layer object is part of the entry, so if the layer (or the
+        # whole model) was replaced under the same name we rebuild
+        if entry is not None and entry[0] is layer:
+            self.hits += 1
+            return entry[1]
+
+        self.misses += 1
+        with layer.output.graph.as_default():
+            func = K.function(
+                list(inputs) + [K.learning_phase()], list(outputs))
+        self.funcs[key] = (layer, func)
+        return func
+
+    def invalidate(self, layer=None):
+        """ Drop the cached functions of one layer, or of all layers """
+
+        if layer is None:
+            self.funcs.clear()
+            return
 
-    if mat is None or len(mat) == 0:
-        return (0).to_bytes(4, 'little')
+        for key in [k for k, v in self.funcs.items() if v[0] is layer]:
+            del self.funcs[key]
 
-    # First get the size of each dim, and the amount of dims
-    dims = mat.shape
+    def stats(self):
+        return {
+            'size': len(self.funcs),
+            'hits': self.hits,
+            'misses': self.misses
+        }
+
+
+class EvalCache(object):
+    """ Remembers the outputs of blocks together with the versions of
+    everything they were computed from, so that an evaluation only has to
+    re-run the blocks whose code, ports, links, inputs or weights changed.
+    Code blocks depend on the weights if they get a model or layer as
+    input. Code blocks that read anything else that can change (like
+    globals) should turn off their 'cache'.
+
+    Note that cached outputs are shared between executions, so code blocks
+    get copies of their array inputs (see eval_blocks), in case they modify
+    them in place """
+
+    def __init__(self):
+        # Edit version of each block (code, ports, links)
+        self.versions = {}
+        # Block id -> (signature, out) of the last successful eval
+        self.entries = {}
+        # Block id -> stamp of the last computed output of that block
+        self.stamps = {}
+        # Block id -> (out, summary) of the cached output of visual blocks
+        self.summaries = {}
+        self.stamp = count(1)
+        # Version of the model weights, bumped whenever training changes them
+        self.weights = 0
+        self.hits = 0
+        self.misses = 0
+
+    def touch(self, block):
+        """ Mark a block as changed """
+        self.versions[block.id] = self.versions.get(block.id, 0) + 1
+
+    def touch_weights(self):
+        """ Mark the weights of all layers as changed """
+        self.weights += 1
+
+    def forget(self, block):
+        self.versions.pop(block.id, None)
+        self.entries.pop(block.id, None)
+        self.stamps.pop(block.id, None)
+        self.summaries.pop(block.id, None)
+
+    def signature(self, block, weights=None, sample=None, inputs=None):
+        """ Everything the output of a block depends on. Layers are
+        evaluated with the current weights, unless a version is given,
+        and with all of their inputs unless a sample size is given.
+        inputs are the (port, link) pairs of the block if taken earlier """
+
+        if inputs is None:
+            inputs = list(block.inputs.items())
+
+        if isinstance(block, LayerBlock):
+            weights = (self.weights if weights is None else weights, sample)
+        elif self.uses_model(inputs):
+            # These use the live model, never the weights of a snapshot
+            weights = (self.weights, None)
+        else:
+            weights = None
+        ins = tuple((k, None) if l is None else
+                    (k, l.fromBlock.id, l.fromPort, self.stamps.get(
+                        l.fromBlock.id)) for k, l in inputs)
+        return (self.versions.get(block.id, 0), weights, ins)
+
+    @staticmethod
+    def uses_model(inputs):
+        """ Whether a block gets a model or layer as input (given its
+        (port, link) pairs), so its output changes along with the weights """
+
+        return any(
+            l is not None and isinstance(l.fromBlock, VariableBlock)
+            and isinstance(l.fromBlock.value, Layer) for _, l in inputs)
+
+    def get(self, block, sig):
+        """ Get the cached output of a block, if it is still up to date """
+
+        if not getattr(block, 'cache', True):
+            self.misses += 1
+            return None
+
+        entry = self.entries.get(block.id)
+        if entry is not None and entry[0] == sig:
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        return None
+
+    def put(self, block, sig, out):
+        """ Save the output of a block, failed outputs are not cached """
+
+        self.stamps[block.id] = next(self.stamp)
+        if out[0] is None and getattr(block, 'cache', True):
+            self.entries[block.id] = (sig, out)
+        else:
+            self.entries.pop(block.id, None)
+        self.summaries.pop(block.id, None)
+
+    def summary(self, block, out):
+        """ Get the summary of a cached output, if it was computed before """
+
+        entry = self.summaries.get(block.id)
+        if entry is not None and entry[0] is out:
+            return entry[1]
+        return None
+
+    def set_summary(self, block, out, summary):
+        """ Keep the summary of an output along with its cache entry """
+
+        entry = self.entries.get(block.id)
+        if entry is not None and entry[1] is out:
+            self.summaries[block.id] = (out, summary)
+
+    def stats(self):
+        return {
+            'size': len(self.entries),
+            'hits': self.hits,
+            'misses': self.misses
+        }
+
+
+class WeightShape(object):
+    """ Stands in for the value of a weight that no block reads, so the
+    metadata of an execution still shows its shape like for an array """
+
+    def __init__(self, weight):
+        self.shape = K.int_shape(weight)
+
+    def to_json(self):
+        return "[" + ', '.join(map(str, self.shape)) + "]"
+
+
+class WeightCache(object):
+    """ Current values of the weights of our layers, read from the backend
+    only when a block needs them. The values are kept until training
+    changes the weights, so all blocks that need them share one copy """
+
+    def __init__(self):
+        # Weight version (see EvalCache) the values were read at
+        self.step = None
+        # (layer name, weight index) -> (layer, value)
+        self.values = {}
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, layer, indices):
+        """ Get the values of the weights of a layer with the given indices """
+
+        with self.lock:
+            if self.step != eval_cache.weights:
+                self.step = eval_cache.weights
+                self.values = {}
+
+            # Entries of a layer that was replaced under the same name
+            # are read again, like in FunctionCache
+            missing = []
+            for i in indices:
+                entry = self.values.get((layer.name, i))
+                if entry is None or entry[0] is not layer:
+                    missing.append(i)
+            if len(missing) > 0:
+                vals = K.batch_get_value([layer.weights[i] for i in missing])
+                for i, v in zip(missing, vals):
+                    self.values[(layer.name, i)] = (layer, v)
+
+            self.misses += len(missing)
+            self.hits += len(indices) - len(missing)
+            return [self.values[(layer.name, i)][1] for i in indices]
+
+    def stats(self):
+        return {
+            'size': len(self.values),
+            'hits': self.hits,
+            'misses': self.misses
+        }
+
+
+class CycleError(Exception):
+    """ Raised when the links between blocks form a cycle """
+
+    def __init__(self, blocks):
+        super(CycleError, self).__init__(
+            'Cycle between blocks ' + ', '.join(b.id for b in blocks))
+        self.blocks = blocks
+
+
+class Scheduler(object):
+    """ Computes the order in which blocks have to be executed, so that
+    every block runs after all the blocks it takes inputs from """
+
+    def __init__(self):
+        # Block id -> blocks it takes inputs from
+        self.upstream = None
+        # Execution plans, by the ids of the blocks that were requested
+        self.plans = {}
+        # Bumped on every change, so we don't keep an index or plan
+        # that was built from a graph that changed in the meantime
+        self.version = 0
+
+    def invalidate(self):
+        """ Call whenever blocks or links are added or removed """
+        self.version += 1
+        self.upstream = None
+        self.plans = {}
+
+    def index(self):
+        """ Adjacency index of the block graph, built from the links.
+        Hold graph.lock while using it from another thread """
+
+        upstream = self.upstream
+        if upstream is None:
+            version = self.version
+            upstream = {}
+            for b in list(graph.blocks.values()):
+                deps = OrderedDict()
+                for l in list(b.inputs.values()):
+                    if l is not None:
+                        deps[l.fromBlock.id] = l.fromBlock
+                upstream[b.id] = list(deps.values())
+            if self.version == version:
+                self.upstream = upstream
+        return upstream
+
+    def deps(self, block):
+        return self.index().get(block.id, [])
+
+    def depends(self, block, other):
+        """ Check whether block (indirectly) takes inputs from other """
+
+        seen = set()
+        todo = [block]
+        while len(todo) > 0:
+            b = todo.pop()
+            for d in self.deps(b):
+                if d is other:
+                    return True
+                if d.id not in seen:
+                    seen.add(d.id)
+                    todo.append(d)
+        return False
+
+    def plan(self, targets):
+        """ Get the execution plan for the given blocks: A list of these
+        blocks and all the blocks they depend on in topological order """
+
+        version = self.version
+        plans = self.plans
+        key = tuple(b.id for b in targets)
+        if key in plans:
+            return plans[key]
+
+        index = self.index()
+
+        def deps(b):
+            return index.get(b.id, [])
+
+        # Collect all the blocks we need to run
+        nodes = OrderedDict()
+        todo = list(targets)
+        while len(todo) > 0:
+            b = todo.pop()
+            if b.id in nodes:
+                continue
+            nodes[b.id] = b
+            todo.extend(deps(b))
+
+        # Kahn's algorithm: Repeatedly run the blocks that have no
+        # dependencies left. Start from the end of our collection so that
+        # upstream blocks come first when there is a choice
+        degree = {}
+        downstream = {}
+        for b in nodes.values():
+            degree[b.id] = len(deps(b))
+            for d in deps(b):
+                downstream.setdefault(d.id, []).append(b)
+
+        ready = deque(b for b in reversed(nodes.values()) if degree[b.id] == 0)
+        order = []
+        while len(ready) > 0:
+            b = ready.popleft()
+            order.append(b)
+            for n in downstream.get(b.id, []):
+                degree[n.id] -= 1
+                if degree[n.id] == 0:
+                    ready.append(n)
+
+        # Anything left over is waiting on itself
+        if len(order) < len(nodes):
+            raise CycleError([b for b in nodes.values() if degree[b.id] > 0])
+
+        # Only keep the plan if the graph didn't change while we built it
+        if self.version == version:
+            plans[key] = order
+        return order
+
+
+class BlockExecutor(object):
+    """ Runs the blocks of an execution plan. With more than one worker,
+    blocks whose inputs are ready run concurrently on a thread pool """
+
+    def __init__(self, workers=1):
+        self.workers = workers
+        self.pool = None
+
+    def run(self, bs, fn, deps):
+        """ Call fn for each block, after it was called for all its inputs.
+        deps maps block ids to the blocks they take inputs from """
+
+        if self.workers <= 1 or len(bs) <= 1:
+            for b in bs:
+                fn(b)
+            return
+
+        if self.pool is None or self.pool._max_workers != self.workers:
+            self.pool = ThreadPoolExecutor(max_workers=self.workers)
+
+        # Count the inputs each block is still waiting for
+        ids = set(b.id for b in bs)
+        waiting = {}
+        downstream = {}
+        for b in bs:
+            ds = [d for d in deps[b.id] if d.id in ids]
+            waiting[b.id] = len(ds)
+            for d in ds:
+                downstream.setdefault(d.id, []).append(b)
+
+        ready = [b for b in bs if waiting[b.id] == 0]
+        running = {}
+        while len(ready) > 0 or len(running) > 0:
+            for b in ready:
+                running[self.pool.submit(fn, b)] = b
+            ready = []
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for f in done:
+                b = running.pop(f)
+                # Block errors are caught in fn, anything else is a bug
+                f.result()
+                for n in downstream.get(b.id, []):
+                    waiting[n.id] -= 1
+                    if waiting[n.id] == 0:
+                        ready.append(n)
+
+
+class BatchRunner(object):
+    """ Runs layer functions on their inputs in chunks of 'batch_size'
+    samples, so the memory the backend needs stays bounded no matter how
+    many samples we pass in. The outputs of the chunks are written into
+    arrays that we allocate once, after the first chunk. Set 'limit' to
+    only compute the outputs of the first samples and stop there """
+
+    def __init__(self, batch_size=None, limit=None):
+        self.batch_size = batch_size
+        self.limit = limit
+
+    def run(self, func, xs, values):
+        """ Call func(inputs=xs + values), where xs are the inputs that
+        have a sample dim and values the inputs that don't """
+
+        n = len(xs[0]) if len(xs) > 0 and isinstance(xs[0], np.ndarray) \
+            and xs[0].ndim > 0 else None
+        if self.batch_size is None or n is None or any(
+                not isinstance(x, np.ndarray) or x.ndim == 0 or len(x) != n
+                for x in xs):
+            return func(inputs=xs + values)
+
+        if self.limit is not None:
+            n = min(n, self.limit)
+        if n <= self.batch_size and n == len(xs[0]):
+            return func(inputs=xs + values)
+
+        outs = None
+        for start in range(0, n, self.batch_size):
+            stop = min(start + self.batch_size, n)
+            chunk = func(inputs=[x[start:stop] for x in xs] + values)
+
+            # Outputs without a sample dim can't be computed in chunks
+            if any(np.ndim(o) == 0 or len(o) != stop - start for o in chunk):
+                return func(inputs=[x[:n] for x in xs] + values)
+
+            if outs is None:
+                outs = [
+                    np.empty((n, ) + o.shape[1:], dtype=o.dtype)
+                    for o in chunk
+                ]
+            for out, o in zip(outs, chunk):
+                out[start:stop] = o
+        return outs
+
+
+class SpilledArray(object):
+    """ Placeholder for an array of an execution that was written to disk """
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        # Memory map the file, so only the parts we read are loaded
+        return np.load(self.path, mmap_mode='r')
+
+
+class ResultStore(object):
+    """ Execution results by execution id. Once the arrays held by all
+    executions exceed max_bytes, the least recently used executions
+    are evicted. Arrays shared between executions are counted once.
+
+    If spill_dir is set, evicted executions are written to that directory
+    as .npy files instead, and are memory mapped when requested again.
+    Arrays shared between executions are written once, and only the last
+    max_spilled executions are kept on disk.
 
-    # Then write the amount of dims, and each dim size
-    str = len(dims).to_bytes(4, 'little')
-    for dim in dims:
-        str += dim.to_bytes(4, 'little')
+    Serialized results of the executions in memory are cached along with
+    them, and count towards max_bytes as well """
 
-    # Then write the bytes of the matrix. This is similar to 'tobytes()'
-    # See https://docs.scipy.org/doc/numpy-1.14.0/reference/generated/numpy.ndarray.tostring.html
-    str += mat.astype(np.float32).tostring()
-    return str
+    def __init__(self,
+                 max_bytes=1 << 30,
+                 max_expired=10000,
+                 spill_dir=None,
+                 max_spilled=100):
+        self.max_bytes = max_bytes
+        self.max_expired = max_expired
+        self.spill_dir = spill_dir
+        self.max_spilled = max_spilled
+        # Execution id -> outs with the arrays replaced by SpilledArray
+        self.spilled = OrderedDict()
+        # Evicted executions that still have to be written to disk
+        self.spilling = OrderedDict()
+        # Path -> [weak ref to the array, number of spilled executions]
+        self.files = {}
+        # id(array) -> path of the file we wrote it to
+        self.paths = {}
+        self.fileCount = count()
+        # Execution id -> outs, least recently used first
+        self.entries = OrderedDict()
+        # id(array) -> [array, number of executions holding it]
+        self.arrays = {}
+        self.nbytes = 0
+        self.evicted = 0
+        # Ids of evicted executions, so we can tell them apart from bad ids
+        self.expired = OrderedDict()
+        # Execution id -> {key -> serialized result}, and their sizes
+        self.encoded = {}
+        self.encodedBytes = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = Lock()
+        # Only one thread writes to disk at a time
+        self.spillLock = Lock()
+
+        # Spilled files of earlier runs can't be used anymore
+        if spill_dir is not None and os.path.isdir(spill_dir):
+            for f in os.listdir(spill_dir):
+                if f.startswith('spill-') and f.endswith('.npy'):
+                    os.remove(os.path.join(spill_dir, f))
+
+    @staticmethod
+    def arrays_of(outs):
+        """ All the distinct arrays in the outputs of an execution """
+
+        arrays = {}
+        for out in outs.values():
+            if out[1] is None:
+                continue
+            for v in out[1].values():
+                if isinstance(v, np.ndarray):
+                    arrays[id(v)] = v
+        return arrays.values()
+
+    def put(self, execId, outs):
+        """ Add the outs of an execution. This can write evicted executions
+        to disk, so it should be called on the thread that evaluated them """
+
+        with self.lock:
+            for arr in self.arrays_of(outs):
+                ref = self.arrays.get(id(arr))
+                if ref is None:
+                    self.arrays[id(arr)] = [arr, 1]
+                    self.nbytes += arr.nbytes
+                else:
+                    ref[1] += 1
+            self.entries[execId] = outs
+            self.evict()
+
+        self.spill()
+
+    def evict(self):
+        # We always keep the newest execution, even if it's too large
+        while self.nbytes > self.max_bytes and len(self.entries) > 1:
+            execId, outs = self.entries.popitem(last=False)
+            self.release(outs)
+            self.encoded.pop(execId, None)
+            self.nbytes -= self.encodedBytes.pop(execId, 0)
+            self.evicted += 1
+            if self.spill_dir is not None:
+                # Written to disk by the next spill(), outside of our lock
+                self.spilling[execId] = outs
+                continue
+            self.expire(execId)
+
+    def expire(self, execId):
+        self.expired[execId] = True
+        while len(self.expired) > self.max_expired:
+            self.expired.popitem(last=False)
+
+    def spill(self):
+        """ Write the executions we evicted to disk """
+
+        with self.spillLock:
+            while True:
+                with self.lock:
+                    if len(self.spilling) == 0:
+                        return
+                    execId, outs = next(iter(self.spilling.items()))
+                    writes, spilled = self.spill_files(outs)
+
+                for path, arr in writes:
+                    np.save(path, arr)
+
+                with self.lock:
+                    del self.spilling[execId]
+                    self.spilled[execId] = spilled
+                    while len(self.spilled) > self.max_spilled:
+                        self.drop(*self.spilled.popitem(last=False))
+
+    def spill_files(self, outs):
+        """ Assign files to the arrays of an execution. Returns the arrays
+        we still have to write, and the outs referring to the files """
+
+        writes = []
+        files = {}
+        for arr in self.arrays_of(outs):
+            # We can't memory map arrays of python objects
+            if arr.dtype.hasobject:
+                continue
+
+            # Arrays that are shared with executions we spilled
+            # before are already on disk
+            path = self.paths.get(id(arr))
+            if path is None or self.files[path][0]() is not arr:
+                path = os.path.join(
+                    self.spill_dir,
+                    'spill-' + str(next(self.fileCount)) + '.npy')
+                self.files[path] = [weakref.ref(arr), 0]
+                self.paths[id(arr)] = path
+                writes.append((path, arr))
+            self.files[path][1] += 1
+            files[id(arr)] = SpilledArray(path)
+
+        if len(writes) > 0:
+            os.makedirs(self.spill_dir, exist_ok=True)
+        return writes, {
+            blockId: [out[0], None if out[1] is None else OrderedDict(
+                (k, files.get(id(v), v)) for k, v in out[1].items())]
+            for blockId, out in outs.items()
+        }
+
+    def drop(self, execId, outs):
+        """ Remove a spilled execution, and the files only it used """
+
+        for out in outs.values():
+            if out[1] is None:
+                continue
+            for v in out[1].values():
+                if not isinstance(v, SpilledArray):
+                    continue
+                ref = self.files.get(v.path)
+                if ref is None:
+                    continue
+                ref[1] -= 1
+                if ref[1] == 0:
+                    del self.files[v.path]
+                    os.remove(v.path)
+        self.paths = {
+            k: p for k, p in self.paths.items() if p in self.files
+        }
+        self.expire(execId)
+
+    def release(self, outs):
+        for arr in self.arrays_of(outs):
+            ref = self.arrays[id(arr)]
+            ref[1] -= 1
+            if ref[1] == 0:
+                del self.arrays[id(arr)]
+                self.nbytes -= arr.nbytes
+
+    def get(self, execId):
+        """ Get the outs of an execution, None if it's unknown or evicted """
+
+        with self.lock:
+            outs = self.entries.get(execId)
+            if outs is not None:
+                self.entries.move_to_end(execId)
+                return outs
+            outs = self.spilling.get(execId)
+            if outs is not None:
+                return outs
+            outs = self.spilled.get(execId)
+
+        if outs is None:
+            return None
+
+        # The execution can be dropped while we map its files, then it
+        # is expired just like if we didn't find it above
+        try:
+            return {
+                blockId: [out[0], None if out[1] is None else OrderedDict(
+                    (k, v.load() if isinstance(v, SpilledArray) else v)
+                    for k, v in out[1].items())]
+                for blockId, out in outs.items()
+            }
+        except FileNotFoundError:
+            return None
+
+    def get_encoded(self, execId, key):
+        """ Get a cached serialized result of an execution """
+
+        with self.lock:
+            encoded = self.encoded.get(execId)
+            if encoded is not None and key in encoded:
+                self.hits += 1
+                return encoded[key]
+            self.misses += 1
+            return None
+
+    def put_encoded(self, execId, key, value, nbytes):
+        """ Cache a serialized result of an execution in memory. Executions
+        this evicts are written to disk by the next put() """
+
+        with self.lock:
+            if execId not in self.entries:
+                return
+            self.encoded.setdefault(execId, {})[key] = value
+            self.encodedBytes[execId] = self.encodedBytes.get(execId, 0) + nbytes
+            self.nbytes += nbytes
+            self.evict()
+
+    def is_expired(self, execId):
+        # Waits for a drop() that is still removing the files of execId
+        with self.lock:
+            return execId in self.expired
+
+    def keys(self):
+        with self.lock:
+            return list(self.spilled.keys()) + list(self.spilling.keys()) + \
+                list(self.entries.keys())
+
+    def stats(self):
+        return {
+            'size': len(self.entries),
+            'bytes': self.nbytes,
+            'max_bytes': self.max_bytes,
+            'evicted': self.evicted,
+            'spilled': len(self.spilled),
+            'spilled_files': len(self.files),
+            'encoded': {
+                'bytes': sum(self.encodedBytes.values()),
+                'hits': self.hits,
+                'misses': self.misses
+            }
+        }
+
+
+class WeightSnapshot(object):
+    """ A copy of the weights of all exposed layers at one point during
+    training, so we can evaluate the layers while training goes on """
+
+    def __init__(self, epoch=None, batch=None, trigger=None, step=None):
+        with graph.lock:
+            layers = [b.layer for b in blocks if isinstance(b, LayerBlock)]
+        # Read all the weights with a single backend call
+        values = K.batch_get_value([w for l in layers for w in l.weights])
+
+        self.epoch = epoch
+        self.batch = batch
+        self.trigger = trigger
+        self.step = step if step is not None else eval_cache.weights
+        # Snapshots that were merged into this one because
+        # the visualization couldn't keep up
+        self.skipped = []
+        self.weights = {}
+        i = 0
+        for l in layers:
+            self.weights[l.name] = values[i:i + len(l.weights)]
+            i += len(l.weights)
+
+    def get(self, layer):
+        return self.weights.get(layer.name, [])
+
+    def to_json(self):
+        return {
+            'epoch': self.epoch,
+            'batch': self.batch,
+            'trigger': self.trigger,
+            'step': self.step,
+            'skipped': self.skipped
+        }
+
+
+def feed_weights(layers, snapshot):
+    """ The weight tensors of the layers and the values we feed them with,
+    so that a layer function computes its output with the snapshot weights.
+    Without a snapshot we use the current weights and feed nothing """
+
+    if snapshot is None:
+        return [], []
+
+    tensors = []
+    values = []
+    for l in layers:
+        tensors.extend(l.weights)
+        values.extend(snapshot.get(l))
+    return tensors, values
 
 
 class Variable(object):
@@ -233,6 +1367,9 @@ class CodeBlock(Block):
             self.inputs = OrderedDict([('x0', None)])
             self.outputs = OrderedDict([('y0', [])])
             self.code = code
+        # Whether the output can be reused while the code and inputs stay
+        # the same. Turn this off if the code reads anything else
+        self.cache = getattr(self, 'cache', True)
 
     def to_json(self):
         """ This is called by our custom json serializer """
@@ -240,12 +1377,15 @@ class CodeBlock(Block):
         json = super(CodeBlock, self).to_json()
         json['class'] = 'CodeBlock'
         json['code'] = self.code
+        json['cache'] = self.cache
         return json
 
     def eval(self, gs, context):
         # Empty all outputs (if not already set - this allows
         # passing inputs by using the same port name)
-        for k in self.outputs.keys():
+        # Ports can be added while we run on another thread
+        outputs = list(self.outputs.keys())
+        for k in outputs:
             if k not in context:
                 context[k] = None
 
@@ -254,26 +1394,50 @@ class CodeBlock(Block):
 
         # Save the output ports of our execution
         outs = {}
-        for k in self.outputs.keys():
+        for k in outputs:
             outs[k] = context[k]
 
         # Return an object with our output ports
         return outs
 
 
+def layer_inputs(layer):
+    """ The input tensors of a layer, for its first use in a model """
+
+    x = layer.get_input_at(0)
+    return x if isinstance(x, list) else [x]
+
+
+def inbound_layers(layer):
+    """ The layers whose outputs are the inputs of a layer (in the order
+    of its inputs), for its first use in a model """
+
+    # Keras renamed this to a private attribute in 2.1.3
+    nodes = getattr(layer, '_inbound_nodes', None)
+    if nodes is None:
+        nodes = layer.inbound_nodes
+    if len(nodes) == 0:
+        return []
+
+    ls = nodes[0].inbound_layers
+    return ls if isinstance(ls, list) else [ls]
+
+
 class LayerBlock(Block):
     """ An block representing a layer of a model """
 
     def __init__(self, layer, x=10, y=10):
         super(LayerBlock, self).__init__(id=layer.name, x=x, y=y)
         self.layer = layer
-        self.inputs = OrderedDict([
-            ('input', None)
-        ])
+        # Layers with several inputs (Add, Concatenate, ...) get one port each
+        n = len(layer_inputs(layer))
+        self.inputs = OrderedDict(
+            [('input', None)] if n == 1 else
+            [('input' + str(i), None) for i in range(n)])
         self.outputs = OrderedDict([
             ('output', []),
         ] + [
-            ("w"+str(i), []) for (i, _) in enumerate(layer.get_weights())
+            ("w"+str(i), []) for (i, _) in enumerate(layer.weights)
         ])
 
     def to_json(self):
@@ -284,18 +1448,41 @@ class LayerBlock(Block):
         json['type'] = type(self.layer).__name__
         return json
 
-    def eval(self, gs, context):
-        x = context['input']
-        eval_result = OrderedDict(
-            [("w"+str(i), v) for (i, v) in enumerate(self.layer.get_weights())])
-        if self.layer is None or x is None:
+    def eval(self, gs, context, output=None, snapshot=None):
+        # The context holds our inputs in the order of our ports
+        xs = list(context.values())
+
+        # Only the weights that are linked to other blocks are read
+        ports = [
+            k for k, ls in list(self.outputs.items())
+            if k != 'output' and len(ls) > 0
+        ]
+        indices = [int(k[1:]) for k in ports]
+        if snapshot is None:
+            weights = weight_cache.get(self.layer, indices)
+        else:
+            weights = [snapshot.get(self.layer)[i] for i in indices]
+        eval_result = OrderedDict([
+            (k, WeightShape(self.layer.weights[int(k[1:])]))
+            for k in self.outputs if k != 'output'
+        ])
+        eval_result.update(zip(ports, weights))
+        if self.layer is None or any(x is None for x in xs):
             eval_result.update({'output': None})
             return eval_result
 
+        # Our output was already computed as part of a fused layer chain
+        if output is not None:
+            eval_result.update({'output': output})
+            return eval_result
+
         with self.layer.output.graph.as_default():
-            layerFunc = K.function(
-                [self.layer.input] + [K.learning_phase()], [self.layer.output])
-            eval_result.update({'output': layerFunc(inputs=[x])[0]})
+            tensors, values = feed_weights([self.layer], snapshot)
+            layerFunc = layer_funcs.get(
+                self.layer, layer_inputs(self.layer) + tensors,
+                [self.layer.output])
+            eval_result.update(
+                {'output': layer_runner.run(layerFunc, xs, values)[0]})
             return eval_result
 
 
@@ -341,31 +1528,239 @@ class VisualBlock(CodeBlock):
         ])
         if self.code == '' or not self.code:
             self.code = '__output__ = input'
+        # How we send the output to clients, one of QUANTIZE_MODES or None
+        # to send it exactly. Clients can override this per request
+        self.quantize = getattr(self, 'quantize', None)
 
     def to_json(self):
         """ This is called by our custom json serializer """
 
         json = super(VisualBlock, self).to_json()
         json['class'] = 'VisualBlock'
+        json['quantize'] = self.quantize
         return json
 
 
+class Graph(object):
+    """ The blocks and the links between them, indexed by their ids.
+
+    The adjacency lives on the ports of the blocks: an input port holds its
+    link (or None), an output port the list of its links. Adding and
+    removing blocks and links keeps both in sync """
+
+    def __init__(self):
+        self.blocks = OrderedDict()
+        self.links = OrderedDict()
+        # Evaluations run on other threads, so the handlers hold this while
+        # they change the graph (blocks, links and ports), and evaluations
+        # while they read it
+        self.lock = RLock()
+
+    def block(self, id):
+        return self.blocks.get(id)
+
+    def link(self, id):
+        return self.links.get(id)
+
+    def add_block(self, block):
+        with self.lock:
+            self.blocks[block.id] = block
+            scheduler.invalidate()
+
+    def remove_block(self, block):
+        """ Remove a block together with all links from and to it """
+
+        with self.lock:
+            for link in list(block.inputs.values()):
+                if link is not None:
+                    self.remove_link(link)
+            for ls in list(block.outputs.values()):
+                for link in list(ls):
+                    self.remove_link(link)
+
+            self.blocks.pop(block.id, None)
+            scheduler.invalidate()
+
+    def add_link(self, link):
+        with self.lock:
+            self.links[link.id] = link
+            link.fromBlock.outputs[link.fromPort].append(link)
+            link.toBlock.inputs[link.toPort] = link
+            scheduler.invalidate()
+
+    def remove_link(self, link):
+        with self.lock:
+            if self.links.pop(link.id, None) is None:
+                return
+
+            if link.toBlock.inputs.get(link.toPort) is link:
+                link.toBlock.inputs[link.toPort] = None
+            ls = link.fromBlock.outputs.get(link.fromPort)
+            if ls is not None and link in ls:
+                ls.remove(link)
+            scheduler.invalidate()
+
+    def visual_blocks(self):
+        """ All visual blocks, safe to call from any thread """
+
+        with self.lock:
+            return [b for b in self.blocks.values() if isinstance(b, VisualBlock)]
+
+
+class MoveBroadcaster(object):
+    """ Sends block moves to the clients at most 'rate' times per second.
+
+    Dragging a block sends a move for every mouse move, so we only keep the
+    latest position of every moved block, and send them all together as
+    one 'block_moves' event of [{id, x, y}] per tick """
+
+    def __init__(self, rate=30):
+        self.interval = 1.0 / rate
+        self.moves = OrderedDict()
+        self.pending = False
+        self.received = 0
+        self.sent = 0
+
+    def move(self, block):
+        self.moves[block.id] = block
+        self.received += 1
+        if not self.pending:
+            self.pending = True
+            eventlet.spawn_after(self.interval, self.flush)
+
+    def forget(self, block):
+        self.moves.pop(block.id, None)
+
+    def flush(self):
+        self.pending = False
+        if len(self.moves) == 0:
+            return
+
+        moves = [{'id': b.id, 'x': b.x, 'y': b.y} for b in self.moves.values()]
+        self.moves.clear()
+        self.sent += len(moves)
+        sio.emit('block_moves', data=moves)
+
+    def stats(self):
+        return {'received': self.received, 'sent': self.sent}
+
+
+class GraphView(Sequence):
+    """ Read-only list of the blocks or links of the graph. Iterating it
+    goes over a copy taken under the graph lock, so it's safe while the
+    graph changes on another thread. Use the graph to make changes """
+
+    def __init__(self, items):
+        self.items = items
+
+    def list(self):
+        with graph.lock:
+            return list(self.items.values())
+
+    def __len__(self):
+        return len(self.items)
+
+    def __getitem__(self, i):
+        return self.list()[i]
+
+    def __iter__(self):
+        return iter(self.list())
+
+    def to_json(self):
+        return self.list()
+
+
 # Exposed variables
 vars = {}
-# Blocks of code
-blocks = []
-# Links between blocks
-links = []
-# Cached execution results
-results = {}
+# Blocks of code and the links between them
+graph = Graph()
+# Read-only lists of all blocks and links, that stay up to date with the
+# graph. These are also visible to code blocks, which can index and
+# iterate them, but have to go through the graph to change them
+blocks = GraphView(graph.blocks)
+links = GraphView(graph.links)
+# Cached execution results, set 'max_bytes' to limit their memory use and
+# 'spill_dir' (e.g. 'save/results') to keep evicted executions on disk
+results = ResultStore(max_bytes=1 << 30)
+# Compiled backend functions of our layers
+layer_funcs = FunctionCache()
+# Weights of our layers at the current training step
+weight_cache = WeightCache()
+# Client session id -> (visual block ids, options) of pushed results
+subscriptions = {}
+# Outputs of blocks from previous executions
+eval_cache = EvalCache()
+# Execution order of our blocks
+scheduler = Scheduler()
+# Batches the block moves we send to clients
+mover = MoveBroadcaster(rate=30)
+# Runs our blocks, set 'workers' to evaluate independent blocks concurrently
+executor = BlockExecutor(workers=1)
+# Runs our layers on their inputs, set 'batch_size' to None to pass all
+# samples at once or 'limit' to only compute the first samples
+layer_runner = BatchRunner(batch_size=256)
+
+
+class DataSaver(object):
+    """ Saves our blocks and links to disk.
+
+    Changes are coalesced: save() only marks the data as changed, and it
+    is written once 'delay' seconds later on the web server thread, so
+    dragging a block around doesn't rewrite the file for every move. We
+    write to a temporary file and move it over the old one, so a crash
+    never leaves a half written file behind """
+
+    def __init__(self, path='save/data.json', delay=1.0):
+        self.path = path
+        self.delay = delay
+        self.lock = Lock()
+        self.dirty = False
+        self.pending = False
+        self.requests = 0
+        self.writes = 0
+
+    def save(self):
+        with self.lock:
+            self.dirty = True
+            self.requests += 1
+            if self.pending:
+                return
+            self.pending = True
+        eventlet.spawn_after(self.delay, self.flush)
+
+    def flush(self):
+        """ Write the data now, if it changed since the last write """
+
+        with self.lock:
+            self.pending = False
+            if not self.dirty:
+                return
+            self.dirty = False
+            self.writes += 1
+
+            bs = [b for b in blocks if not isinstance(b, LayerBlock)]
+            ls = [l for l in links if l.implicit == False]
+            data = json.dumps({'blocks': bs, 'links': ls}, cls=MyJSONEncoder)
+
+            tmp = self.path + '.tmp'
+            with open(tmp, 'w') as outfile:
+                outfile.write(data)
+                outfile.flush()
+                os.fsync(outfile.fileno())
+            os.replace(tmp, self.path)
+
+    def stats(self):
+        return {'requests': self.requests, 'writes': self.writes}
+
+
+# Writes our blocks and links to disk, a while after they changed
+saver = DataSaver()
+# Don't lose the latest changes when we shut down
+atexit.register(saver.flush)
 
 
 def save_data():
-    with open('save/data.json', 'w') as outfile:
-        bs = [b for b in blocks if not isinstance(b, LayerBlock)]
-        ls = [l for l in links if l.implicit == False]
-        obj = {'blocks': bs, 'links': ls}
-        json.dump(obj, outfile, cls=MyJSONEncoder)
+    saver.save()
 
 
 def parse_data_object(d):
@@ -388,24 +1783,22 @@ def parse_data_object(d):
 
 def load_data():
     try:
-        with open('save/data.json', 'r') as infile:
-            global links
-            global blocks
+        with open(saver.path, 'r') as infile:
             # Parse all the code blocks from file
             data = json.load(infile, object_hook=parse_data_object)
 
-            # Add the code blocks to the main blocks array
-            blocks.extend(data['blocks'])
+            # Add the code blocks to the graph
+            for b in data['blocks']:
+                graph.add_block(b)
 
             # Parse the links, now that we have all the blocks ready
             for l in data['links']:
-                fromBlock = next((b for b in blocks if b.id == l['fromId']),
-                                 None)
+                fromBlock = graph.block(l['fromId'])
                 if fromBlock is None:
                     print('load_data: Invalid block id ' + l['fromId'])
                     return
 
-                toBlock = next((b for b in blocks if b.id == l['toId']), None)
+                toBlock = graph.block(l['toId'])
                 if toBlock is None:
                     print('load_data: Invalid block id ' + l['toId'])
                     return
@@ -413,11 +1806,7 @@ def load_data():
                 fromPort = l['fromPort']
                 toPort = l['toPort']
 
-                link = Link(fromBlock, fromPort, toBlock, toPort)
-                links.append(link)
-
-                fromBlock.outputs[fromPort].append(link)
-                toBlock.inputs[toPort] = link
+                graph.add_link(Link(fromBlock, fromPort, toBlock, toPort))
 
     except FileNotFoundError:
         pass
@@ -433,16 +1822,32 @@ def connect():
 @sio.on('disconnect')
 def disconnect():
     print('disconnect')
+    subscriptions.pop(request.sid, None)
 
 
 # Get all data (blocks, links and variables)
 @sio.on('data')
 def get_data():
     return {
-        'blocks': blocks,
-        'links': links,
+        'blocks': list(blocks),
+        'links': list(links),
         'vars': list(map(lambda kv: Variable(kv[0], kv[1]), vars.items())),
-        'results': list(results.keys())
+        'results': results.keys()
+    }
+
+
+# Get some internal statistics about our caches
+@sio.on('stats')
+def get_stats():
+    return {
+        'layer_funcs': layer_funcs.stats(),
+        'weight_cache': weight_cache.stats(),
+        'eval_cache': eval_cache.stats(),
+        'results': results.stats(),
+        'bridge': bridge.stats(),
+        'dispatcher': dispatcher.stats(),
+        'saver': saver.stats(),
+        'mover': mover.stats()
     }
 
 
@@ -460,7 +1865,7 @@ def add_block(data):
         newBlock = VisualBlock()
 
     if newBlock is not None:
-        blocks.append(newBlock)
+        graph.add_block(newBlock)
         sio.emit('block_create', data=newBlock)
 
         save_data()
@@ -469,12 +1874,23 @@ def add_block(data):
 # Edit code of a block
 @sio.on('block_change')
 def edit_block(data):
-    block = next((b for b in blocks if b.id == data['id']), None)
+    block = graph.block(data['id'])
     if block is None:
         return
 
     if isinstance(block, CodeBlock) and 'code' in data:
         block.code = data['code']
+        eval_cache.touch(block)
+
+    if isinstance(block, CodeBlock) and 'cache' in data:
+        block.cache = bool(data['cache'])
+
+    if isinstance(block, VisualBlock) and 'quantize' in data:
+        if data['quantize'] is not None and \
+                data['quantize'] not in QUANTIZE_MODES:
+            print('block_change: Invalid quantize mode ' + data['quantize'])
+            return
+        block.quantize = data['quantize']
 
     sio.emit('block_change', data=block)
     save_data()
@@ -483,20 +1899,20 @@ def edit_block(data):
 # Move block around
 @sio.on('block_move')
 def move_block(data):
-    block = next((b for b in blocks if b.id == data['id']), None)
+    block = graph.block(data['id'])
     if block is None:
         return
 
     block.x = data['x']
     block.y = data['y']
-    sio.emit('block_move', data=block)
+    mover.move(block)
     save_data()
 
 
 # Deleting blocks
 @sio.on('block_delete')
 def delete_block(data):
-    block = next((b for b in blocks if b.id == data['id']), None)
+    block = graph.block(data['id'])
     if block is None:
         print('block_delete: Could not find block ' + data['id'])
         return
@@ -505,103 +1921,231 @@ def delete_block(data):
         print('block_delete: Layer blocks cannot be deleted')
         return
 
-    # Remove all links to this block
-    for portName in block.inputs:
-        link = block.inputs[portName]
-        if link is not None:
-            link.fromBlock.outputs[link.fromPort].remove(link)
-            links.remove(link)
-
-    # Remove all links from this block
-    for portName in block.outputs:
-        for link in block.outputs[portName]:
-            link.toBlock.inputs[link.toPort] = None
-            links.remove(link)
-
-    # Remove from blocks array
-    blocks.remove(block)
+    # Remove the block and all links from and to it
+    graph.remove_block(block)
+    eval_cache.forget(block)
+    mover.forget(block)
     sio.emit('block_delete', data=block)
     save_data()
 
 
+def sample_inputs(x, sample):
+    """ Take an evenly spaced sample of the first dim of an input, the same
+    samples every time. sample is either a number or a fraction of samples """
+
+    if not isinstance(x, np.ndarray) or x.ndim == 0:
+        return x
+
+    n = len(x)
+    k = int(sample * n) if isinstance(sample, float) else int(sample)
+    if k <= 0 or k >= n:
+        return x
+    return x[np.linspace(0, n - 1, k).astype(np.int64)]
+
+
+def find_layer_chains(bs):
+    """ Group the connected LayerBlocks of an execution into chains.
+    Returns a dict mapping the id of the first block of each chain
+    to the list of blocks in that chain (in execution order) """
+
+    # Which chain (by id of the first block) each layer block belongs to
+    chain_of = {}
+    chains = OrderedDict()
+    for b in bs:
+        if not isinstance(b, LayerBlock):
+            continue
+
+        # A layer can only join a chain if all of its inputs are
+        # outputs of layers in that same chain
+        ls = list(b.inputs.values())
+        roots = set(
+            chain_of.get(l.fromBlock.id) if l is not None
+            and isinstance(l.fromBlock, LayerBlock) and l.fromPort == 'output'
+            else None for l in ls)
+        root = roots.pop() if len(roots) == 1 else None
+
+        if root is None:
+            chain_of[b.id] = b.id
+            chains[b.id] = [b]
+        else:
+            chain_of[b.id] = root
+            chains[root].append(b)
+
+    # Single layers are just evaluated on their own
+    return OrderedDict((k, v) for k, v in chains.items() if len(v) > 1)
+
+
+def eval_layer_chain(chain, context, snapshot=None):
+    """ Evaluate a chain of layers with one backend call, fetching the
+    outputs of all layers at once. Returns a dict block id -> output """
+
+    root = chain[0]
+    xs = list(context.values())
+    if any(x is None for x in xs):
+        return {}
+
+    with root.layer.output.graph.as_default():
+        tensors, values = feed_weights([b.layer for b in chain], snapshot)
+        chainFunc = layer_funcs.get(root.layer,
+                                    layer_inputs(root.layer) + tensors,
+                                    [b.layer.output for b in chain])
+        outputs = layer_runner.run(chainFunc, xs, values)
+    return {b.id: v for b, v in zip(chain, outputs)}
+
+
 # Eval an array of blocks, building the execution tree required.
 # Emit "eval_results" to inform the client about new evaluations available.
 # On "eval_results", the client is provided with metadata about all outputs.
-def eval_blocks(blocks):
-    global results
-
-    # Build our execution tree
-    bs = blocks.copy()
-    todo = blocks.copy()
-    while len(todo) > 0:
-        b = todo.pop()
-        ins = list(
-            map(lambda l: l.fromBlock,
-                filter(lambda l: l is not None, b.inputs.values())))
-        for bi in ins:
-            if bi not in bs:
-                # Well, easy, just insert in front
-                bs.insert(0, bi)
-            else:
-                # Do not need to insert, but surely b depends on bi so check position
-                # This means that we need to check bi comes *before* b
-                bi_pos = bs.index(bi)
-                b_pos = bs.index(b)
-                if bi_pos > b_pos:
-                    # Wrong. Move bi just before b.
-                    bs.insert(b_pos, bs.pop(bi_pos))
-        todo.extend(ins)
-
+# With force, no block output comes from the cache, with rerun only the
+# outputs of the requested blocks don't (but those of their inputs can).
+# Evaluation stops before the next block once cancelled() returns True,
+# then nothing is stored or published and None is returned.
+def eval_blocks(blocks, force=False, publish=True, snapshot=None,
+                sample=None, cancelled=None, rerun=False):
     outs = {}
+    targets = set(b.id for b in blocks) if rerun else set()
+
+    # The handlers can change the graph while we evaluate, so we take
+    # everything we need from it while it's locked
+    with graph.lock:
+        # Build our execution plan
+        try:
+            bs = scheduler.plan(blocks)
+        except CycleError as err:
+            print('eval_blocks: ' + str(err))
+            bs = []
+            for b in blocks:
+                outs[b.id] = [str(err), None]
+
+        # The blocks each block takes inputs from, and its input links
+        deps = {b.id: scheduler.deps(b) for b in bs}
+        inputs = {b.id: list(b.inputs.items()) for b in bs}
+
+        # Consecutive layers are evaluated together in one backend call
+        # when we reach the first layer of their chain
+        chains = find_layer_chains(bs)
+    fused = {}
 
     # Save our globals, they will be exposed to the block eval
     gs = globals()
 
-    # Traverse the blocks
-    for b in bs:
+    # How long each block took to run
+    timings = {}
+    # Statistics about the outputs of visual blocks
+    summaries = {}
+
+    # Evaluate one block, all the blocks it depends on have already run
+    def run(b):
+        # A newer evaluation replaces this one, so don't bother
+        if cancelled is not None and cancelled():
+            outs[b.id] = ['Cancelled', None]
+            return
+
         # Collect inputs for this block
         context = {}
 
         # Set inputs from links
-        skip = False
-        for k, l in b.inputs.items():
+        for k, l in inputs[b.id]:
             if l is None:
                 context[k] = None
             else:
-                # We found an input with an error, so skip this block
-                if outs[l.fromBlock.id][1] is None:
-                    skip = True
-                    break
+                # We found an input with an error (or one that isn't
+                # part of our plan), so skip this block
+                if outs.get(l.fromBlock.id, [None, None])[1] is None:
+                    outs[b.id] = ['Error in previous block', None]
+                    eval_cache.put(b, None, outs[b.id])
+                    return
                 # Otherwise set the input to the output of that block
                 context[k] = outs[l.fromBlock.id][1][l.fromPort]
 
-        # If one of our inputs had an error then we just skip this block
-        if skip is True:
-            outs[b.id] = ['Error in previous block', None]
-            continue
+        # Layers that get their input from outside the model only
+        # evaluate a sample of it
+        if sample is not None and isinstance(b, LayerBlock) and not any(
+                isinstance(l.fromBlock, LayerBlock)
+                for _, l in inputs[b.id] if l is not None):
+            context = {
+                k: sample_inputs(v, sample) for k, v in context.items()
+            }
+
+        # Code that uses the model directly would use the live weights, not
+        # those of our snapshot, and call the model while training goes on
+        if snapshot is not None and not isinstance(b, LayerBlock) and \
+                eval_cache.uses_model(inputs[b.id]):
+            outs[b.id] = [
+                'Skipped: Blocks using the model directly are not evaluated '
+                'during training', None
+            ]
+            return
+
+        # Reuse the previous output if nothing this block depends on changed
+        sig = eval_cache.signature(
+            b, snapshot.step if snapshot is not None else None, sample,
+            inputs[b.id])
+        out = None if force or b.id in targets else eval_cache.get(b, sig)
+        if out is not None:
+            outs[b.id] = out
+            summarize(b)
+            return
+
+        # Our inputs are also cached and part of other executions, so code
+        # that changes an array in place must only change its own copy
+        if not isinstance(b, LayerBlock):
+            context = {
+                k: v.copy() if isinstance(v, np.ndarray) else v
+                for k, v in context.items()
+            }
 
+        start = time.time()
         with stdoutIO() as s:
             try:
-                # Run the function
-                out = [None, b.eval(gs, context)]
+                if b.id in chains:
+                    fused.update(
+                        eval_layer_chain(chains[b.id], context, snapshot))
+
+                # Run the function, layers with the weights of our snapshot
+                if isinstance(b, LayerBlock):
+                    out = [None, b.eval(gs, context, output=fused.pop(
+                        b.id, None), snapshot=snapshot)]
+                else:
+                    out = [None, b.eval(gs, context)]
             except:
                 print('Error')
                 # Save any error
                 out = [tb.format_exc(), None]
+        timings[b.id] = time.time() - start
 
-            # Print statements to console. We could also return them or something...
-            text = s.getvalue()
-            if len(text) > 0:
-                print(b.id + ': ' + text)
+        # Print statements to console. We could also return them or something...
+        text = s.getvalue()
+        if len(text) > 0:
+            print(b.id + ': ' + text)
 
         # Save the output ports of our execution
         outs[b.id] = out
+        eval_cache.put(b, sig, out)
+        summarize(b)
+
+    def summarize(b):
+        out = outs[b.id]
+        if not isinstance(b, VisualBlock) or out[0] is not None:
+            return
+
+        # Cached outputs keep their summary, it is only computed once
+        summary = eval_cache.summary(b, out)
+        if summary is None:
+            summary = summarize_matrix(out[1]['__output__'])
+            eval_cache.set_summary(b, out, summary)
+        summaries[b.id] = summary
+
+    # Traverse the blocks
+    executor.run(bs, run, deps)
+    if cancelled is not None and cancelled():
+        return None
 
     # Generate a unique id for this execution
     execId = str(time.time())
 
     # Cache our execution results using a unique id
-    results[execId] = outs
+    results.put(execId, outs)
 
     # Collect our results
     # We add some metadata, specifically, json dumping the results leads to
@@ -610,14 +2154,110 @@ def eval_blocks(blocks):
         'id': execId,
         'blocks': json.loads(MyJSONWrapper.dumps({
             k: d[1] if d[0] is None else False for k, d in outs.items()
-        }))
+        })),
+        'timings': timings,
+        'summaries': summaries,
+        'snapshot': snapshot
     }
 
+    if publish:
+        publish_results(res)
+
+    return res
+
+
+def publish_results(res):
+    """ Inform the clients about a finished execution """
+
     # Inform all clients that a new execution is ready,
     # passing some metadata about the intermediate outputs
     sio.emit('result_new', data=res)
 
-    return res
+    # And send the results to clients that subscribed to them
+    outs = results.get(res['id'])
+    if outs is not None:
+        push_results(res['id'], outs)
+
+
+class EvalDispatcher(object):
+    """ Runs evaluations on a pool of worker threads, so they don't block
+    the web server thread, at most 'workers' at a time.
+
+    Requests for the same blocks are coalesced: While a request is still
+    waiting, newer ones are merged into it (it will see the latest state
+    of the blocks once it starts). A running request that gets a newer one
+    is superseded: it stops before running its next block, and nothing of
+    it is sent to the clients """
+
+    def __init__(self, workers=1):
+        self.workers = workers
+        self.pool = None
+        # Ids of the requested blocks -> latest job for these blocks
+        self.jobs = {}
+        self.coalesced = 0
+        self.superseded = 0
+        self.lock = Lock()
+
+    def submit(self, bs, force=False, rerun=False):
+        key = tuple(sorted(b.id for b in bs))
+        with self.lock:
+            if self.pool is None:
+                self.pool = ThreadPoolExecutor(max_workers=self.workers)
+
+            job = self.jobs.get(key)
+            if job is not None and not job['started']:
+                job['force'] = job['force'] or force
+                job['rerun'] = job['rerun'] or rerun
+                self.coalesced += 1
+                return
+
+            if job is not None:
+                job['superseded'] = True
+                self.superseded += 1
+
+            job = {
+                'blocks': bs,
+                'force': force,
+                'rerun': rerun,
+                'started': False,
+                'superseded': False
+            }
+            self.jobs[key] = job
+            self.pool.submit(self.run, key, job)
+
+    def run(self, key, job):
+        with self.lock:
+            job['started'] = True
+
+        # Nobody waits for our future, so errors have to be printed here
+        try:
+            res = eval_blocks(
+                job['blocks'],
+                force=job['force'],
+                rerun=job['rerun'],
+                publish=False,
+                cancelled=lambda: job['superseded'])
+            if res is not None and not job['superseded']:
+                publish_results(res)
+        except:
+            tb.print_exc()
+        finally:
+            with self.lock:
+                if self.jobs.get(key) is job:
+                    del self.jobs[key]
+
+    def stats(self):
+        return {
+            'workers': self.workers,
+            'jobs': len(self.jobs),
+            'coalesced': self.coalesced,
+            'superseded': self.superseded
+        }
+
+
+# Runs the evaluations requested by clients, set 'workers' to allow
+# several evaluations at the same time
+dispatcher = EvalDispatcher(workers=1)
 
 
 # Evaluate all (visual) blocks
@@ -625,7 +2265,7 @@ def eval_blocks(blocks):
 @sio.on('block_eval_all')
 def eval_all_blocks():
     print('Eval all')
-    eval_blocks([b for b in blocks if isinstance(b, VisualBlock)])
+    dispatcher.submit(graph.visual_blocks())
 
 
 # Evaluating a block (="running")
@@ -634,7 +2274,7 @@ def eval_all_blocks():
 @sio.on('block_eval')
 def eval_block(data):
     # Find the code block by id
-    block = next((b for b in blocks if b.id == data['id']), None)
+    block = graph.block(data['id'])
     if block is None:
         print ('Invalid block')
         return
@@ -645,20 +2285,117 @@ def eval_block(data):
 
     print('Eval: ' + block.id)
 
-    # Run the evaluation for our one block
-    eval_blocks([block])
+    # Run the evaluation for our one block. The block itself always runs
+    # (it may have side effects), the blocks it depends on only if needed
+    dispatcher.submit([block], force=data.get('force', False), rerun=True)
+
+
+def result_encoding(block, options):
+    """ Fingerprint of how a result is cut, reduced and quantized. A delta
+    only works if the client's base was encoded the same way """
+
+    return json.dumps({
+        'roi': options.get('roi'),
+        'shape': options.get('shape'),
+        'reduce': options.get('reduce', 'stride'),
+        'quantize': options.get('quantize', block.quantize)
+    }, sort_keys=True)
+
+
+def get_base_matrix(data, block):
+    """ Get the matrix of a visual block in the execution data['base'],
+    reduced with the same options as the requested one """
+
+    if data.get('base') is None:
+        return None
+
+    # The client has the base encoded differently (e.g. the quantize
+    # setting of the block changed since), so it can't apply a delta
+    if data.get('baseEncoding') != result_encoding(block, data):
+        return None
+
+    baseRes = results.get(data['base'])
+    if baseRes is None or block.id not in baseRes:
+        return None
+
+    res = baseRes[block.id]
+    if res[0] is not None or res[1]['__output__'] is None:
+        return None
+
+    mat, _ = reduce_matrix(
+        res[1]['__output__'],
+        roi=data.get('roi'),
+        shape=data.get('shape'),
+        mode=data.get('reduce', 'stride'))
+    return mat
+
+
+def serialize_result(block, res, options):
+    """ Serialize the successful result of a visual block, with the
+    region, reduction, quantization and base given in options.
+    Returns [error, binary data, metadata] """
+
+    mat = res[1]['__output__']
+    if mat is None:
+        return [None, serialize_matrix(mat), None]
+
+    # Only send the region and resolution the client asked for
+    quantize = options.get('quantize', block.quantize)
+    try:
+        mat, meta = reduce_matrix(
+            mat,
+            roi=options.get('roi'),
+            shape=options.get('shape'),
+            mode=options.get('reduce', 'stride'))
+        meta['encoding'] = result_encoding(block, options)
+
+        # If the client has the result of an earlier execution,
+        # we only send the difference to that one
+        base = get_base_matrix(options, block)
+        if base is not None:
+            payload = serialize_matrix_delta(mat, base, quantize)
+            if payload is not None:
+                meta['base'] = options['base']
+                return [None, payload, meta]
+
+        return [None, serialize_matrix(mat, quantize), meta]
+    except (ValueError, TypeError, IndexError) as err:
+        return ['Invalid result options: ' + str(err), None, None]
+
+
+def encode_result(execId, block, res, options):
+    """ Serialize the result of a visual block (see serialize_result),
+    reusing the serialized data if it was requested the same way before """
+
+    key = json.dumps({
+        'block': block.id,
+        'roi': options.get('roi'),
+        'shape': options.get('shape'),
+        'reduce': options.get('reduce', 'stride'),
+        'quantize': options.get('quantize', block.quantize),
+        'base': options.get('base'),
+        'baseEncoding': options.get('baseEncoding')
+    }, sort_keys=True)
+
+    encoded = results.get_encoded(execId, key)
+    if encoded is None:
+        encoded = serialize_result(block, res, options)
+        results.put_encoded(execId, key, encoded,
+                            len(encoded[1]) if encoded[1] is not None else 0)
+    return encoded
 
 
 # Getting the results of a certain execution for a certain block
 @sio.on('result_get')
 def get_result(data):
-    if data['id'] not in results:
+    allRes = results.get(data['id'])
+    if allRes is None:
+        if results.is_expired(data['id']):
+            return ['Expired execution']
         return ['Invalid execution']
 
-    allRes = results[data['id']]
-
     # Find the block by id
-    block = next((b for b in blocks if b.id == data['blockId']), None)
+    block = graph.block(data['blockId'])
     if block is None:
         return ['Invalid block']
 
@@ -673,33 +2410,146 @@ def get_result(data):
     # If it's a visual block return binary data
     if res[0] is None:
         if isinstance(block, VisualBlock):
-            return [None, serialize_matrix(res[1]['__output__'])]
+            return encode_result(data['id'], block, res, data)
         else:
             return [None, res[1]]
     else:
         return [res[0], None]
 
 
+def push_results(execId, outs):
+    """ Send the results of an execution to all subscribed clients.
+    Clients with the same subscription share one batch, and each result
+    is only serialized once per set of options (see encode_result) """
+
+    batches = {}
+    for sid, (blockIds, options) in list(subscriptions.items()):
+        ids = tuple(sorted(i for i in blockIds if i in outs))
+        if len(ids) == 0:
+            continue
+        optionsKey = json.dumps(options, sort_keys=True)
+
+        key = (ids, optionsKey)
+        if key in batches:
+            sio.emit('result_push', data=batches[key], room=sid)
+            continue
+
+        # One binary frame holding all results, each aligned to 8 bytes
+        # so the client can view them as typed arrays
+        index = []
+        errors = {}
+        parts = []
+        offset = 0
+        for blockId in ids:
+            block = graph.block(blockId)
+            if not isinstance(block, VisualBlock):
+                continue
+            res = outs[blockId]
+            if res[0] is not None:
+                errors[blockId] = res[0]
+                continue
+
+            err, payload, meta = encode_result(execId, block, res, options)
+            if err is not None:
+                errors[blockId] = err
+                continue
+
+            index.append({
+                'id': blockId,
+                'offset': offset,
+                'length': len(payload),
+                'meta': meta
+            })
+            padding = bytes(-len(payload) % 8)
+            parts.extend((payload, padding))
+            offset += len(payload) + len(padding)
+
+        batches[key] = {
+            'id': execId,
+            'blocks': index,
+            'errors': errors,
+            'data': b''.join(parts)
+        }
+        sio.emit('result_push', data=batches[key], room=sid)
+
+
+# Get the (decimated) history of the training metrics
+@sio.on('metrics_get')
+def get_metrics():
+    return metrics.history()
+
+
+# Subscribe to have results of visual blocks pushed after every execution
+@sio.on('result_subscribe')
+def subscribe_results(data):
+    options = {
+        k: data[k]
+        for k in ('roi', 'shape', 'reduce', 'quantize') if k in data
+    }
+
+    # Bad options would only fail later, when we push the results
+    err = check_result_options(options)
+    if err is not None:
+        print('result_subscribe: ' + err)
+        return err
+
+    subscriptions[request.sid] = (set(data['blocks']), options)
+
+
+def check_result_options(options):
+    """ Get an error message for invalid result options, None if valid """
+
+    def is_int(v):
+        return isinstance(v, int) and not isinstance(v, bool)
+
+    if options.get('reduce', 'stride') not in REDUCE_MODES:
+        return 'Invalid reduce mode ' + str(options['reduce'])
+    if options.get('quantize') is not None and \
+            options['quantize'] not in QUANTIZE_MODES:
+        return 'Invalid quantize mode ' + str(options['quantize'])
+
+    roi = options.get('roi')
+    if roi is not None and (not isinstance(roi, list) or not all(
+            r is None or (isinstance(r, list) and len(r) == 2
+                          and all(v is None or is_int(v) for v in r))
+            for r in roi)):
+        return 'Invalid roi ' + str(roi)
+
+    shape = options.get('shape')
+    if shape is not None and not is_int(shape) and (
+            not isinstance(shape, list)
+            or not all(v is None or is_int(v) for v in shape)):
+        return 'Invalid shape ' + str(shape)
+    return None
+
+
+@sio.on('result_unsubscribe')
+def unsubscribe_results():
+    subscriptions.pop(request.sid, None)
+
+
 # Creating a port
 @sio.on('port_create')
 def create_port(data):
-    block = next((b for b in blocks if b.id == data['id']), None)
+    block = graph.block(data['id'])
     if block is None:
         print('port_create: Invalid block id ' + data['id'])
         return
 
     portName = data['name']
-    if data['input'] == True:
-        if portName in block.inputs:
-            print('port_create: Port name in use: ' + portName)
-            return
-        block.inputs[portName] = None
-    else:
-        if portName in block.outputs:
-            print('port_create: Port name in use: ' + portName)
-            return
-        block.outputs[portName] = []
+    with graph.lock:
+        if data['input'] == True:
+            if portName in block.inputs:
+                print('port_create: Port name in use: ' + portName)
+                return
+            block.inputs[portName] = None
+        else:
+            if portName in block.outputs:
+                print('port_create: Port name in use: ' + portName)
+                return
+            block.outputs[portName] = []
 
+    eval_cache.touch(block)
     sio.emit('port_create', data={'id': block.id, 'port': portName})
     save_data()
 
@@ -707,22 +2557,27 @@ def create_port(data):
 # Renaming a port
 @sio.on('port_rename')
 def rename_port(data):
-    block = next((b for b in blocks if b.id == data['id']), None)
+    block = graph.block(data['id'])
     if block is None:
         print('port_rename: Invalid block id ' + data['id'])
         return
 
     oldName = data['oldName']
     newName = data['newName']
-    if data['input'] == True:
-        block.inputs = OrderedDict([(newName, v) if k == oldName else (k, v)
-                                    for k, v in block.inputs.items()])
-        # block.inputs[newName] = block.inputs.pop(oldName, None)
-    else:
-        block.outputs = OrderedDict([(newName, v) if k == oldName else (k, v)
-                                     for k, v in block.outputs.items()])
-        # block.outputs[newName] = block.outputs.pop(oldName, None)
+    with graph.lock:
+        if data['input'] == True:
+            block.inputs = OrderedDict(
+                [(newName, v) if k == oldName else (k, v)
+                 for k, v in block.inputs.items()])
+            # block.inputs[newName] = block.inputs.pop(oldName, None)
+        else:
+            block.outputs = OrderedDict(
+                [(newName, v) if k == oldName else (k, v)
+                 for k, v in block.outputs.items()])
+            # block.outputs[newName] = block.outputs.pop(oldName, None)
 
+        scheduler.invalidate()
+    eval_cache.touch(block)
     sio.emit(
         'port_rename',
         data={
@@ -737,17 +2592,20 @@ def rename_port(data):
 # TODO: Clean up the links that this port had
 @sio.on('port_delete')
 def delete_port(data):
-    block = next((b for b in blocks if b.id == data['id']), None)
+    block = graph.block(data['id'])
     if block is None:
         print('port_delete: Invalid block id ' + data['id'])
         return
 
     portName = data['name']
-    if data['input'] == True:
-        block.inputs.pop(portName, None)
-    else:
-        block.outputs.pop(portName, None)
+    with graph.lock:
+        if data['input'] == True:
+            block.inputs.pop(portName, None)
+        else:
+            block.outputs.pop(portName, None)
 
+        scheduler.invalidate()
+    eval_cache.touch(block)
     sio.emit('port_delete', data={'id': block.id, 'port': portName})
     save_data()
 
@@ -755,12 +2613,12 @@ def delete_port(data):
 # Connecting blocks together
 @sio.on('link_create')
 def create_link(data):
-    fromBlock = next((b for b in blocks if b.id == data['fromId']), None)
+    fromBlock = graph.block(data['fromId'])
     if fromBlock is None:
         print('link_create: Invalid block id ' + data['fromId'])
         return
 
-    toBlock = next((b for b in blocks if b.id == data['toId']), None)
+    toBlock = graph.block(data['toId'])
     if toBlock is None:
         print('link_create: Invalid block id ' + data['toId'])
         return
@@ -776,20 +2634,30 @@ def create_link(data):
               toBlock.id)
         return
 
-    alreadyHas = next((l for l in fromBlock.outputs[fromPort]
-                       if l.toBlock == toBlock and l.toPort == toPort), None)
-    if alreadyHas is not None:
-        print('link_create: ' + fromBlock.id + ' already connects to ' +
-              toBlock.id + ' from port ' + fromPort + ' to port ' + toPort)
-        return
+    with graph.lock:
+        alreadyHas = next(
+            (l for l in fromBlock.outputs[fromPort]
+             if l.toBlock == toBlock and l.toPort == toPort), None)
+        if alreadyHas is not None:
+            print('link_create: ' + fromBlock.id + ' already connects to ' +
+                  toBlock.id + ' from port ' + fromPort + ' to port ' +
+                  toPort)
+            return
 
-    link = Link(fromBlock, fromPort, toBlock, toPort)
-    links.append(link)
+        if fromBlock is toBlock or scheduler.depends(fromBlock, toBlock):
+            print('link_create: Linking ' + fromBlock.id + ' to ' +
+                  toBlock.id + ' would create a cycle')
+            return
 
-    fromBlock.outputs[fromPort].append(link)
-    # TODO: Remove any previously existing links on the in port
-    toBlock.inputs[toPort] = link
+        # TODO: Remove any previously existing links on the in port
+        link = Link(fromBlock, fromPort, toBlock, toPort)
+        graph.add_link(link)
 
+        eval_cache.touch(toBlock)
+        # Layers only output the weights that are linked, so this one
+        # has to be evaluated again to output the newly linked weights
+        if isinstance(fromBlock, LayerBlock):
+            eval_cache.touch(fromBlock)
     sio.emit('link_create', data=link)
     save_data()
 
@@ -797,10 +2665,8 @@ def create_link(data):
 # Disconnecting blocks
 @sio.on('link_delete')
 def delete_link(data):
-    global links
-
     # Find link
-    link = next((l for l in links if l.id == data['id']), None)
+    link = graph.link(data['id'])
     if link is None:
         print('link_delete: Invalid link id ' + data['id'])
         return
@@ -809,82 +2675,360 @@ def delete_link(data):
         print('link_delete: Implicit links cannot be deleted')
         return
 
-    # Remove link from blocks
-    link.toBlock.inputs[link.toPort] = None
-    link.fromBlock.outputs[link.fromPort].remove(link)
-
-    # Delete link
-    links.remove(link)
+    # Remove link from the graph and its blocks
+    graph.remove_link(link)
+    eval_cache.touch(link.toBlock)
     sio.emit('link_delete', data=link)
     save_data()
 
 
+class MetricsStream(object):
+    """ Training metrics (loss, accuracy, ...) of every batch.
+
+    The latest values are kept in a ring buffer of 'capacity' rows
+    [step, metric1, metric2, ...], and sent to clients at most every
+    'interval' seconds. The whole history is kept decimated in a fixed
+    amount of buckets with the min, max and mean of their metrics. Once
+    all buckets are used, neighbouring buckets are merged, so the memory
+    we need stays the same no matter how long we train """
+
+    def __init__(self, capacity=4096, buckets=512, interval=0.25):
+        # Merging pairs must leave every bucket with the same amount of
+        # batches, as add() finds the bucket of a batch by division
+        if buckets < 2 or buckets % 2 != 0:
+            raise ValueError('Invalid amount of buckets ' + str(buckets))
+        self.capacity = capacity
+        self.buckets = buckets
+        self.interval = interval
+        self.lock = Lock()
+        self.reset([])
+
+    def reset(self, names):
+        with self.lock:
+            n = len(names)
+            self.names = list(names)
+            self.ring = np.empty((self.capacity, n + 1))
+            # Amount of rows we have seen and sent in total
+            self.count = 0
+            self.sent = 0
+            self.last_push = 0
+
+            self.bucketSize = 1
+            self.used = 0
+            self.steps = np.zeros(self.buckets)
+            self.counts = np.zeros(self.buckets, dtype=np.int64)
+            self.mins = np.full((self.buckets, n), np.inf)
+            self.maxs = np.full((self.buckets, n), -np.inf)
+            self.sums = np.zeros((self.buckets, n))
+
+    def add(self, step, logs):
+        if len(self.names) == 0:
+            self.reset(
+                sorted(k for k, v in logs.items()
+                       if k not in ('batch', 'size') and np.isscalar(v)))
+        vals = np.array(
+            [logs.get(k, np.nan) for k in self.names], dtype=np.float64)
+
+        with self.lock:
+            row = self.ring[self.count % self.capacity]
+            row[0] = step
+            row[1:] = vals
+            self.count += 1
+
+            i = (self.count - 1) // self.bucketSize
+            if i >= self.buckets:
+                self.merge()
+                i = (self.count - 1) // self.bucketSize
+
+            if self.counts[i] == 0:
+                self.steps[i] = step
+            self.counts[i] += 1
+            np.fmin(self.mins[i], vals, out=self.mins[i])
+            np.fmax(self.maxs[i], vals, out=self.maxs[i])
+            self.sums[i] += vals
+            self.used = i + 1
+
+    def merge(self):
+        """ Merge pairs of buckets, freeing up the second half (the amount
+        of buckets is even, see __init__) """
+
+        h = self.buckets // 2
+        self.steps[:h] = self.steps[0::2]
+        self.counts[:h] = self.counts[0::2] + self.counts[1::2]
+        self.mins[:h] = np.fmin(self.mins[0::2], self.mins[1::2])
+        self.maxs[:h] = np.fmax(self.maxs[0::2], self.maxs[1::2])
+        self.sums[:h] = self.sums[0::2] + self.sums[1::2]
+
+        self.counts[h:] = 0
+        self.mins[h:] = np.inf
+        self.maxs[h:] = -np.inf
+        self.sums[h:] = 0
+        self.bucketSize *= 2
+
+    def due(self):
+        return self.count > self.sent and \
+            time.time() - self.last_push >= self.interval
+
+    def update(self):
+        """ The rows we haven't sent yet, as [step, metric1, ...] matrix """
+
+        with self.lock:
+            start = max(self.sent, self.count - self.capacity)
+            rows = self.ring[np.arange(start, self.count) % self.capacity]
+            self.sent = self.count
+            self.last_push = time.time()
+
+        return {
+            'names': self.names,
+            'data': serialize_matrix(rows.astype(np.float32))
+        }
+
+    def history(self):
+        """ The decimated history: The first step of each bucket, and the
+        min, max and mean of the metrics as [3, buckets, metrics] matrix """
+
+        with self.lock:
+            u = self.used
+            means = self.sums[:u] / np.maximum(self.counts[:u], 1)[:, None]
+            values = np.stack((self.mins[:u], self.maxs[:u], means))
+            steps = self.steps[:u].copy()
+
+        return {
+            'names': self.names,
+            'bucket': self.bucketSize,
+            'steps': serialize_matrix(steps.astype(np.float32)),
+            'values': serialize_matrix(values.astype(np.float32))
+        }
+
+
+# Metrics of the batches of the current training
+metrics = MetricsStream()
+
+
 class FitCallback(Callback):
+    """ Informs our clients about the training progress and evaluates all
+    visual blocks during training.
+
+    When to evaluate: At the end of every epoch (every_epoch), every n
+    batches (every_batches), every n seconds (every_seconds) and/or when
+    the metric 'monitor' improved (mode 'min' or 'max'). With a budget,
+    e.g. 0.05, triggers are skipped while evaluations took more than that
+    fraction of the training time so far. Evaluations that don't happen at
+    the end of an epoch feed only a sample of the inputs to the layers,
+    either a number of samples or a fraction. The timing of each trigger is
+    recorded in 'history'.
+
+    With background=True the evaluation runs on a separate thread with a
+    snapshot of the weights, so training doesn't have to wait for it. If
+    the evaluation can't keep up, stale='latest' merges all waiting
+    snapshots into the newest one, while stale='all' evaluates every one """
+
     last_time = 0
     epochs = 0
     batches = 0
 
+    def __init__(self,
+                 background=True,
+                 stale='latest',
+                 every_epoch=True,
+                 every_batches=None,
+                 every_seconds=None,
+                 monitor=None,
+                 mode='min',
+                 budget=None,
+                 sample=None,
+                 progress_interval=1):
+        super(FitCallback, self).__init__()
+        self.background = background
+        self.stale = stale
+        self.every_epoch = every_epoch
+        self.every_batches = every_batches
+        self.every_seconds = every_seconds
+        self.monitor = monitor
+        self.mode = mode
+        self.budget = budget
+        self.sample = sample
+        self.progress_interval = progress_interval
+
+        self.epoch = 0
+        self.seen = 0
+        # Best value of the monitored metric, in the logs of single batches
+        # and in the (averaged) logs of epochs, they aren't comparable
+        self.best = {'batch': None, 'epoch': None}
+        self.train_start = time.time()
+        self.last_eval = time.time()
+        # Time spent on visualizations, on the training thread and in total
+        self.blocking_time = 0
+        self.eval_time = 0
+        # Timings of each trigger
+        self.history = []
+        self.skipped = 0
+
+        # (snapshot, sample, history record) waiting to be evaluated
+        self.pending = deque()
+        self.lock = Lock()
+        self.pool = None
+
     def set_params(self, params):
         self.batches = math.ceil(params['samples'] / params['batch_size'])
         self.epochs = params['epochs']
 
     def on_train_begin(self, logs={}):
+        self.train_start = time.time()
+        self.last_eval = time.time()
+        metrics.reset([])
         mgr.emit('train_begin', logs)
 
     def on_train_end(self, logs={}):
+        if metrics.count > metrics.sent:
+            mgr.emit('metrics', data=metrics.update())
         mgr.emit('train_end', logs)
 
     def on_batch_begin(self, batch, logs={}):
-        if (time.time() - self.last_time < 1):
+        if (time.time() - self.last_time < self.progress_interval):
             return
         mgr.emit('batch_begin', data={'batch': batch, 'batches': self.batches})
         self.last_time = time.time()
 
+    def on_batch_end(self, batch, logs={}):
+        # Every batch updates the weights, so our cached layer outputs are stale
+        eval_cache.touch_weights()
+        self.seen += 1
+
+        metrics.add(self.seen, logs)
+        if metrics.due():
+            mgr.emit('metrics', data=metrics.update())
+
+        trigger = None
+        if self.every_batches and self.seen % self.every_batches == 0:
+            trigger = 'batches'
+        elif self.every_seconds and \
+                time.time() - self.last_eval >= self.every_seconds:
+            trigger = 'seconds'
+        elif self.improved(logs, 'batch'):
+            trigger = 'improved'
+
+        if trigger is not None:
+            self.visualize(trigger, batch=batch, sample=self.sample)
+
     def on_epoch_begin(self, epoch, logs={}):
+        self.epoch = epoch
         mgr.emit('epoch_begin', data={'epoch': epoch, 'epochs': self.epochs})
 
     def on_epoch_end(self, epoch, logs={}):
-        eval_all_blocks()
+        improved = self.improved(logs, 'epoch')
+        if self.every_epoch:
+            self.visualize('epoch')
+        elif improved:
+            self.visualize('improved')
         mgr.emit('epoch_end', data={'epoch': epoch, 'epochs': self.epochs})
 
+    def improved(self, logs, level):
+        """ Check whether our monitored metric got better, compared to
+        earlier logs of the same level ('batch' or 'epoch') """
+
+        if self.monitor is None or logs.get(self.monitor) is None:
+            return False
+
+        value = logs[self.monitor]
+        best = self.best[level]
+        if best is None or (value < best if self.mode == 'min'
+                            else value > best):
+            self.best[level] = value
+            return True
+        return False
+
+    def visualize(self, trigger, batch=None, sample=None):
+        """ Evaluate all visual blocks, unless we're over our time budget """
+
+        now = time.time()
+        if self.budget is not None and \
+                self.eval_time > self.budget * (now - self.train_start):
+            self.skipped += 1
+            return
+        self.last_eval = now
+
+        record = {
+            'trigger': trigger,
+            'epoch': self.epoch,
+            'batch': batch,
+            'sample': sample,
+            'blocking': 0,
+            'eval': None
+        }
+        self.history.append(record)
+
+        if self.background:
+            self.queue_eval(
+                WeightSnapshot(epoch=self.epoch, batch=batch, trigger=trigger),
+                sample, record)
+        else:
+            eval_blocks(
+                graph.visual_blocks(),
+                sample=sample)
+            record['eval'] = time.time() - now
+            self.eval_time += record['eval']
+
+        record['blocking'] = time.time() - now
+        self.blocking_time += record['blocking']
+        if self.background:
+            self.eval_time += record['blocking']
+
+    def queue_eval(self, snapshot, sample, record):
+        """ Evaluate the visual blocks with a snapshot in the background """
+
+        with self.lock:
+            if self.pool is None:
+                self.pool = ThreadPoolExecutor(max_workers=1)
+
+            # We're behind, so just replace the waiting snapshot
+            if self.stale == 'latest' and len(self.pending) > 0:
+                old = self.pending.pop()[0]
+                snapshot.skipped = old.skipped + [{
+                    'epoch': old.epoch,
+                    'batch': old.batch
+                }]
+                self.pending.append((snapshot, sample, record))
+                return
+
+            self.pending.append((snapshot, sample, record))
+            self.pool.submit(self.run_eval)
+
+    def run_eval(self):
+        with self.lock:
+            snapshot, sample, record = self.pending.popleft()
+        start = time.time()
+        try:
+            eval_blocks(
+                graph.visual_blocks(),
+                snapshot=snapshot,
+                sample=sample)
+        except:
+            tb.print_exc()
+        record['eval'] = time.time() - start
+        self.eval_time += record['eval']
+
 
 def expose_model(model):
     """ Expose a model to the web clients """
 
+    # Any functions we compiled before belong to the old model
+    layer_funcs.invalidate()
+    scheduler.invalidate()
+
     # Add all layers as blocks
-    i = 0
-    for layer in model.layers:
-        blocks.append(LayerBlock(layer, x=i * 150))
-        i += 1
+    for i, layer in enumerate(model.layers):
+        graph.add_block(LayerBlock(layer, x=i * 150))
 
-    # Link the layers 'prev' and 'next'
-    done = {}
+    # Link every input of a layer to the layer it comes from. Layers
+    # outside of the model (like the implicit input layer) are left out
     for layer in model.layers:
-        # Find the next layer by looking for a layer with the same 'input' as this 'output'
-        p = next((l.name for l in model.layers if l.output == layer.input),
-                 None)
-        prev = next((b for b in blocks if b.id == p), None)
-
-        # Find the previous layer by looking for a layer with the same 'output' as this 'input'
-        n = next((l.name for l in model.layers if l.input == layer.output),
-                 None)
-        nxt = next((b for b in blocks if b.id == n), None)
-
-        for b in blocks:
-            if b.id == layer.name:
-                if prev is not None and (prev.id + '-' + b.id) not in done:
-                    link = Link(prev, 'output', b, 'input', implicit=True)
-                    links.append(link)
-                    b.inputs['input'] = link
-                    prev.outputs['output'].append(link)
-                    done[(prev.id + '-' + b.id)] = link
-                if nxt is not None and (b.id + '-' + nxt.id) not in done:
-                    link = Link(b, 'output', nxt, 'input', implicit=True)
-                    links.append(link)
-                    b.outputs['output'].append(link)
-                    nxt.inputs['input'] = link
-                    done[b.id + '-' + nxt.id] = link
-                break
+        b = graph.block(layer.name)
+        for port, prev in zip(b.inputs.keys(), inbound_layers(layer)):
+            prevBlock = graph.block(prev.name)
+            if prevBlock is not None and prevBlock is not b:
+                graph.add_link(
+                    Link(prevBlock, 'output', b, port, implicit=True))
 
 
 def expose_variables(newVars):
@@ -898,6 +3042,15 @@ def expose_variables(newVars):
             continue
         vars[key] = value
 
+    # Update the blocks that expose these variables
+    with graph.lock:
+        bs = list(blocks)
+    for b in bs:
+        if isinstance(b, VariableBlock) and b.name in newVars \
+                and b.name in vars and b.value is not vars[b.name]:
+            b.value = vars[b.name]
+            eval_cache.touch(b)
+
 
 def start():
     """ Start our webserver and return the socket.io 